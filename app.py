@@ -6,11 +6,14 @@ try:
 except ImportError:
     pass
 
+import asyncio
 import gradio as gr
 from pathlib import Path
 from document_loader import DocumentLoader
 from vector_store import VectorStore
+from ingest_jobs import IngestionJobs, FINISHED
 from llm_manager import EnhancedLLMManager, QueryRouter
+from config import MODEL_CONCURRENCY, INGEST_PROGRESS_INTERVAL
 import os
 from datetime import datetime
 
@@ -22,32 +25,83 @@ class AITutorApp:
         self.llm_manager = EnhancedLLMManager()
         self.llm_manager.set_student_level("intermediate")
         self.router = QueryRouter(self.vector_store, self.llm_manager)
+        self.jobs = IngestionJobs(self.loader, self.vector_store)
+        self.jobs.resume()
         print("Application initialized successfully", end="\n")
     
-    def upload_document(self, file):
-        """Handle document upload and processing"""
+    def upload_document(self, file, subject="", class_name="", replace=False, job_ids=None):
+        """Queue an uploaded document for ingestion and return at once; follow_uploads reports progress"""
+        job_ids = list(job_ids or [])
         if file is None:
-            return "No file uploaded", ""
+            return "No file uploaded", "", job_ids
         
         try:
-            file_path = file.name
-            filename = Path(file_path).name
+            file_path = file if isinstance(file, str) else file.name
+            print(f"\nQueueing uploaded file: {Path(file_path).name}", end="\n")
             
-            print(f"\nProcessing uploaded file: {filename}", end="\n")
+            # Pages stream into the chunker and chunks into the store batch by batch, in a background worker
+            extra_metadata = {'subject': (subject or "").strip(), 'class_name': (class_name or "").strip()}
+            job = self.jobs.submit(file_path, extra_metadata, replace=bool(replace))
+            job_ids.append(job['id'])
+            return self._format_jobs(self._session_jobs(job_ids)), "", job_ids
             
-            documents = self.loader.process_document(file_path)
-            
-            if not documents:
-                return f"Error: Could not process {filename}", ""
-            
-            self.vector_store.add_documents(documents)
-            
-            stats = self.vector_store.get_stats()
-            
-            success_msg = f"""✅ Successfully processed: {filename}
+        except Exception as e:
+            return f"❌ Error processing file: {str(e)}", "", job_ids
+    
+    async def follow_uploads(self, job_ids):
+        """Poll this page's uploads until all have finished, then refresh the document lists and forget the jobs.
+        
+        Waits asynchronously between polls, so following a long job holds no worker thread.
+        """
+        while True:
+            jobs = self._session_jobs(job_ids)
+            if all(job['status'] in FINISHED for job in jobs):
+                for job in jobs:
+                    self.jobs.discard(job['id'])
+                status = self._format_jobs(jobs) if jobs else gr.update()
+                yield (status, *self.refresh_document_choices(), [])
+                return
+            yield self._format_jobs(jobs), gr.update(), gr.update(), job_ids
+            await asyncio.sleep(INGEST_PROGRESS_INTERVAL)
+    
+    def _session_jobs(self, job_ids):
+        """Jobs of this page that have not been discarded yet"""
+        return [job for job in map(self.jobs.get, job_ids or []) if job is not None]
+    
+    def _format_jobs(self, jobs):
+        """Render several ingestion jobs, one block each"""
+        return "\n\n".join(self._format_job(job) for job in jobs)
+    
+    def _format_job(self, job):
+        """Render an ingestion job's progress or outcome"""
+        filename = job['filename']
+        if job['status'] == 'queued':
+            return f"⏳ {filename} is queued for processing..."
+        if job['status'] == 'duplicate':
+            return f"ℹ️ {filename} is already in the database (identical file), nothing to do."
+        if job['status'] == 'failed':
+            return f"❌ Error processing {filename}: {job['error']}"
+        
+        if job['status'] == 'running':
+            pages = f"{job['pages']}/{job['total_pages']}" if job['total_pages'] else str(job['pages'])
+            resumed = f" (resumed, attempt {job['attempts']})" if job['attempts'] > 1 else ""
+            return f"""⚙️ Processing {filename}{resumed}
+
+- Pages read: {pages}
+- Text chunks created: {job['chunks']}
+- Chunks embedded and indexed: {job['committed']} (new: {job['added']})"""
+        
+        result = job['result']
+        stats = self.vector_store.get_stats()
+        replace_note = ""
+        if job['mode'] == 'replace':
+            replace_note = f"\n- Replaced previous version: {result['kept']} chunks unchanged, {result['removed']} removed"
+        
+        return f"""✅ Successfully processed: {filename}
             
 📊 Statistics:
-- Text chunks created: {len(documents)}
+- Text chunks created: {result['chunks']}
+- New chunks indexed: {result['added']} (duplicates skipped: {result['chunks'] - result['added']}){replace_note}
 - Total documents in database: {stats['total_documents']}
 - Embedding model: {stats['embedding_model']}
 - Device: {stats['device']}
@@ -55,51 +109,74 @@ class AITutorApp:
 - Reranking: {'✅' if stats['reranking'] else '❌'}
 
 You can now ask questions about this material!"""
-            
-            return success_msg, ""
-            
-        except Exception as e:
-            return f"❌ Error processing file: {str(e)}", ""
     
-    def answer_question(self, question, history):
-        """Handle question answering with model indication"""
+    @staticmethod
+    def _build_filters(sources=None, subject="", class_name="", page_from=0, page_to=0):
+        """Retrieval filters from the search scope controls (empty controls are ignored)"""
+        return {
+            'source': list(sources or []),
+            'subject': (subject or "").strip(),
+            'class_name': (class_name or "").strip(),
+            'page_from': int(page_from) if page_from else None,
+            'page_to': int(page_to) if page_to else None
+        }
+    
+    def answer_question(self, question, history, sources=None, subject="", class_name="", page_from=0, page_to=0):
+        """Handle question answering with model indication, streaming the answer as it is generated"""
         if not question.strip():
-            return history + [("", "Please enter a question.")]
+            yield history + [("", "Please enter a question.")]
+            return
         
-        stats = self.vector_store.get_stats()
-        if stats['total_documents'] == 0:
-            return history + [(question, "⚠️ No documents uploaded yet. Please upload study materials first.")]
+        if self.vector_store.collection.count() == 0:
+            yield history + [(question, "⚠️ No documents uploaded yet. Please upload study materials first.")]
+            return
         
         try:
-            result = self.router.answer_query(question, n_results=5)
-            
-            # Determine which model was used
-            complexity = result['complexity']
-            model_used = 'mistral:7b (Detailed)' if complexity == 'complex' else 'phi3:mini (Fast)'
+            answer_text = ""
+            filters = self._build_filters(sources, subject, class_name, page_from, page_to)
+            for event in self.router.answer_query_stream(question, n_results=5, filters=filters):
+                if event['type'] == 'start':
+                    complexity, cached, sources = event['complexity'], event['cached'], event['sources']
+                    model, reason = event['model'], event['routing_reason']
+                elif event['type'] == 'token':
+                    answer_text += event['text']
+                else:
+                    answer_text = event['result']['answer']
+                yield history + [(question, self._format_answer(complexity, model, reason, cached, answer_text, sources))]
             
-            answer = f"""**🤖 Model: {model_used}**
-**Query Type: {complexity}**
+        except Exception as e:
+            yield history + [(question, f"❌ Error: {str(e)}")]
+    
+    def _format_answer(self, complexity, model, reason, cached, answer_text, sources):
+        """Render an answer with its model, query type and sources"""
+        # Determine which model was used
+        if model is None:
+            model = self.llm_manager.large_model if complexity == 'complex' else self.llm_manager.small_model
+        model_used = f"{model} (Detailed)" if model == self.llm_manager.large_model else f"{model} (Fast)"
+        
+        cache_note = " (cached)" if cached else ""
+        
+        answer = f"""**🤖 Model: {model_used}{cache_note}**
+**Query Type: {complexity}** ({reason})
 
 **📚 Answer:**
 
-{result['answer']}
+{answer_text}
 
 ---
 **📖 Sources:**
 """
-            for i, source in enumerate(result['sources'][:3], 1):
-                similarity_pct = source['similarity'] * 100
-                answer += f"\n{i}. {source['metadata']['source']} (Chunk {source['metadata']['chunk_id']}) - {similarity_pct:.1f}% relevant"
-            
-            return history + [(question, answer)]
-            
-        except Exception as e:
-            return history + [(question, f"❌ Error: {str(e)}")]
+        for i, source in enumerate(sources[:3], 1):
+            similarity_pct = source['similarity'] * 100
+            answer += f"\n{i}. {source['metadata']['source']} (Chunk {source['metadata']['chunk_id']}) - {similarity_pct:.1f}% relevant"
+        
+        return answer
     
-    def generate_quiz_handler(self, topic, num_questions):
+    def generate_quiz_handler(self, topic, num_questions, sources=None, subject="", class_name=""):
         """Handle quiz generation"""
         try:
-            quiz = self.router.generate_quiz(topic if topic.strip() else None, int(num_questions))
+            filters = self._build_filters(sources, subject, class_name)
+            quiz = self.router.generate_quiz(topic if topic.strip() else None, int(num_questions), filters)
             return f"📝 **Generated Quiz:**\n\n{quiz}"
         except Exception as e:
             return f"❌ Error generating quiz: {str(e)}"
@@ -120,6 +197,18 @@ You can now ask questions about this material!"""
         self.llm_manager.set_student_level(level)
         return f"✅ Student level changed to: {level}"
     
+    def remove_document(self, source):
+        """Remove a single document from the database"""
+        if not source:
+            return "Select a document to remove."
+        removed = self.vector_store.delete_source(source)
+        return f"🗑️ Removed {source} ({removed} chunks)."
+    
+    def refresh_document_choices(self):
+        """Update the document dropdowns with the indexed documents"""
+        sources = self.vector_store.list_sources()
+        return gr.update(choices=sources), gr.update(choices=sources, value=None)
+    
     def clear_database(self):
         """Clear all documents"""
         self.vector_store.clear_collection()
@@ -136,7 +225,10 @@ You can now ask questions about this material!"""
     def get_stats_display(self):
         """Get formatted statistics"""
         stats = self.vector_store.get_stats()
+        # Walks the whole vocabulary, so it is only measured for this panel
+        keyword_memory = self.vector_store.bm25.memory_usage() if stats['hybrid_search'] else None
         history_count = len(self.llm_manager.conversation_history) if hasattr(self.llm_manager, 'conversation_history') else 0
+        loaded_models = self.llm_manager.residency.loaded_models()
         
         return f"""**System Statistics:**
 - Total Documents: {stats['total_documents']}
@@ -144,11 +236,20 @@ You can now ask questions about this material!"""
 - Student Level: {self.llm_manager.student_level}
 - Hybrid Search: {'✅' if stats['hybrid_search'] else '❌'}
 - Reranking: {'✅' if stats['reranking'] else '❌'}
-- Device: {stats['device']}
+- Device: {stats['device']}{self._format_keyword_memory(keyword_memory)}
 
 **Model Information:**
 - Small Model: phi3:mini (simple queries)
-- Large Model: mistral:7b (complex queries)"""
+- Large Model: mistral:7b (complex queries)
+- Loaded Models: {', '.join(loaded_models) or 'none'} (policy: {self.llm_manager.residency.policy})"""
+    
+    @staticmethod
+    def _format_keyword_memory(memory):
+        """One stats line for the keyword index's in-process and memory-mapped footprint"""
+        if not memory:
+            return ""
+        return (f"\n- Keyword Index: {memory['terms']} terms, {memory['total_bytes'] / 2**20:.1f} MB in memory, "
+                f"{memory['mapped_bytes'] / 2**20:.1f} MB mapped")
     
     def launch(self):
         """Launch Gradio interface"""
@@ -174,6 +275,12 @@ You can now ask questions about this material!"""
                         type="filepath"
                     )
                     
+                    with gr.Row():
+                        subject_input = gr.Textbox(label="Subject (optional)", placeholder="e.g., Biology", scale=1)
+                        class_input = gr.Textbox(label="Class (optional)", placeholder="e.g., 10", scale=1)
+                    
+                    replace_input = gr.Checkbox(label="Replace the indexed document with the same filename", value=False)
+                    
                     upload_btn = gr.Button("Process Document", variant="primary")
                     upload_output = gr.Textbox(
                         label="Upload Status",
@@ -187,6 +294,10 @@ You can now ask questions about this material!"""
                     
                     export_output = gr.Textbox(label="Export Status", lines=2)
                     
+                    with gr.Row():
+                        remove_choice = gr.Dropdown(choices=[], label="Indexed documents", scale=3)
+                        remove_btn = gr.Button("Remove Document", variant="stop", scale=1)
+                    
                     gr.Markdown("### 🎯 Student Level")
                     level_dropdown = gr.Radio(
                         choices=["beginner", "intermediate", "advanced"],
@@ -216,6 +327,18 @@ You can now ask questions about this material!"""
                         )
                         submit_btn = gr.Button("Ask", variant="primary", scale=1)
                     
+                    with gr.Accordion("🔎 Search Scope", open=False):
+                        source_filter = gr.Dropdown(
+                            choices=[],
+                            multiselect=True,
+                            label="Only search these documents (leave empty for all)"
+                        )
+                        with gr.Row():
+                            subject_filter = gr.Textbox(label="Subject", placeholder="e.g., Biology", scale=2)
+                            class_filter = gr.Textbox(label="Class", placeholder="e.g., 10", scale=1)
+                            page_from = gr.Number(label="From page", value=0, precision=0, scale=1)
+                            page_to = gr.Number(label="To page", value=0, precision=0, scale=1)
+                    
                     gr.Examples(
                         examples=[
                             "What is photosynthesis?",
@@ -252,16 +375,38 @@ You can now ask questions about this material!"""
                         hint_output = gr.Markdown()
             
             # Event handlers
+            # Uploads return as soon as they are queued; progress is then followed only until they finish
+            upload_jobs = gr.State([])
+            
+            # Answers run concurrently up to the models' combined slots; the client queues per model
+            chat_concurrency = sum(MODEL_CONCURRENCY.values())
+            
             upload_btn.click(
                 fn=self.upload_document,
-                inputs=[file_input],
-                outputs=[upload_output, question_input]
+                inputs=[file_input, subject_input, class_input, replace_input, upload_jobs],
+                outputs=[upload_output, question_input, upload_jobs]
+            ).then(
+                fn=self.follow_uploads,
+                inputs=[upload_jobs],
+                outputs=[upload_output, source_filter, remove_choice, upload_jobs],
+                concurrency_limit=None
+            )
+            
+            remove_btn.click(
+                fn=self.remove_document,
+                inputs=[remove_choice],
+                outputs=[upload_output]
+            ).then(
+                fn=self.refresh_document_choices,
+                outputs=[source_filter, remove_choice]
             )
             
             submit_btn.click(
                 fn=self.answer_question,
-                inputs=[question_input, chatbot],
-                outputs=[chatbot]
+                inputs=[question_input, chatbot, source_filter, subject_filter, class_filter, page_from, page_to],
+                outputs=[chatbot],
+                concurrency_limit=chat_concurrency,
+                concurrency_id="chat"
             ).then(
                 lambda: "",
                 outputs=[question_input]
@@ -269,8 +414,10 @@ You can now ask questions about this material!"""
             
             question_input.submit(
                 fn=self.answer_question,
-                inputs=[question_input, chatbot],
-                outputs=[chatbot]
+                inputs=[question_input, chatbot, source_filter, subject_filter, class_filter, page_from, page_to],
+                outputs=[chatbot],
+                concurrency_limit=chat_concurrency,
+                concurrency_id="chat"
             ).then(
                 lambda: "",
                 outputs=[question_input]
@@ -279,6 +426,9 @@ You can now ask questions about this material!"""
             clear_btn.click(
                 fn=self.clear_database,
                 outputs=[upload_output, chatbot]
+            ).then(
+                fn=self.refresh_document_choices,
+                outputs=[source_filter, remove_choice]
             )
             
             export_btn.click(
@@ -294,7 +444,7 @@ You can now ask questions about this material!"""
             
             quiz_btn.click(
                 fn=self.generate_quiz_handler,
-                inputs=[quiz_topic, quiz_num],
+                inputs=[quiz_topic, quiz_num, source_filter, subject_filter, class_filter],
                 outputs=[quiz_output]
             )
             
@@ -314,6 +464,11 @@ You can now ask questions about this material!"""
                 outputs=[stats_display]
             )
             
+            demo.load(
+                fn=self.refresh_document_choices,
+                outputs=[source_filter, remove_choice]
+            )
+            
             gr.Markdown("""
             ---
             ### 🚀 Features
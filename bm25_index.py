@@ -0,0 +1,749 @@
+import copy
+import json
+import math
+import os
+import shutil
+import sys
+from array import array
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+import numpy as np
+from cache import LRUCache
+
+# Bump when the on-disk layout changes; older snapshots are then rebuilt
+SNAPSHOT_FORMAT = 3
+MAX_SEGMENTS = 8
+MAX_DELETED_FRACTION = 0.25
+TERM_CACHE_SIZE = 4096
+# Chunk metadata kept per document so filters on it are resolved inside the index
+FILTER_FIELDS = ('subject', 'class_name')  # matched by value
+PAGE_FIELD = 'page'                        # matched by range
+
+
+def tokenize(text: str) -> List[str]:
+    """Tokenize text the same way for documents and queries"""
+    return text.lower().split()
+
+
+def _nbytes(buffer) -> int:
+    """Size of the data in a NumPy array or array.array"""
+    if buffer is None:
+        return 0
+    return int(buffer.nbytes) if isinstance(buffer, np.ndarray) else len(buffer) * buffer.itemsize
+
+
+class _Segment:
+    """Immutable block of postings for a contiguous range of slots.
+
+    Postings are stored term-major (CSR) and the forward index doc-major, so
+    both can be memory-mapped straight from .npy files. Term ids in the
+    arrays are local to the segment; once bound to an index they are mapped
+    to its shared vocabulary and the segment keeps no strings of its own.
+    """
+
+    ARRAYS = ('offsets', 'slots', 'tfs', 'doc_offsets', 'doc_term_ids', 'doc_tfs', 'doc_len')
+
+    def __init__(self, first_slot: int, vocab: Optional[List[str]], ids: List[Optional[str]],
+                 partitions: List[Optional[str]], arrays: Dict[str, np.ndarray], name: str = None,
+                 fields: Dict[str, List] = None):
+        self.first_slot = first_slot
+        self.vocab = vocab              # local term id -> term, until bound
+        self.ids = ids
+        self.partitions = partitions
+        self.fields = fields or {}      # filter field -> per-document value
+        self.arrays = arrays
+        self.name = name
+        self.global_ids = None          # local term id -> index-wide term id
+        self._order = None              # argsort of global_ids
+        self._sorted_ids = None
+
+    @property
+    def num_docs(self) -> int:
+        return len(self.ids)
+
+    def bind(self, global_ids: np.ndarray):
+        """Map local term ids to index-wide ids and drop the local vocabulary"""
+        self.global_ids = np.asarray(global_ids, dtype=np.int32)
+        self._order = np.argsort(self.global_ids, kind="stable").astype(np.int32)
+        self._sorted_ids = self.global_ids[self._order]
+        self.vocab = None
+
+    @classmethod
+    def build(cls, first_slot: int, ids: List[Optional[str]], doc_offsets: np.ndarray, term_ids: np.ndarray,
+              tfs: np.ndarray, partitions: List[Optional[str]], fields: Dict[str, List] = None) -> "_Segment":
+        """Build a bound segment from per-document runs of (index-wide term id, tf)"""
+        doc_offsets = np.array(doc_offsets, dtype=np.int64)
+        doc_tfs = np.array(tfs, dtype=np.int32)
+        global_ids, local_ids = np.unique(np.asarray(term_ids, dtype=np.int32), return_inverse=True)
+        local_ids = local_ids.astype(np.int32)
+
+        doc_index = np.repeat(np.arange(len(ids), dtype=np.int32), np.diff(doc_offsets))
+        doc_len = np.bincount(doc_index, weights=doc_tfs, minlength=len(ids)).astype(np.int32)
+        order = np.argsort(local_ids, kind="stable")
+        term_counts = np.bincount(local_ids, minlength=len(global_ids))
+        offsets = np.concatenate([[0], np.cumsum(term_counts)]).astype(np.int64)
+
+        segment = cls(first_slot, None, ids, partitions, {
+            'offsets': offsets,
+            'slots': (first_slot + doc_index[order]).astype(np.int32),
+            'tfs': doc_tfs[order].astype(np.float32),
+            'doc_offsets': doc_offsets,
+            'doc_term_ids': local_ids,
+            'doc_tfs': doc_tfs,
+            'doc_len': doc_len,
+        }, fields=fields)
+        segment.bind(global_ids)
+        return segment
+
+    def postings(self, term_id: int) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """(slots, tfs) for an index-wide term id, or None if the segment never saw it"""
+        i = int(np.searchsorted(self._sorted_ids, term_id))
+        if i == len(self._sorted_ids) or self._sorted_ids[i] != term_id:
+            return None
+        local = self._order[i]
+        start, end = self.arrays['offsets'][local], self.arrays['offsets'][local + 1]
+        return self.arrays['slots'][start:end], self.arrays['tfs'][start:end]
+
+    def doc_terms(self, slot: int) -> Tuple[np.ndarray, np.ndarray]:
+        """(index-wide term ids, tfs) of one document in this segment"""
+        local = slot - self.first_slot
+        start, end = self.arrays['doc_offsets'][local], self.arrays['doc_offsets'][local + 1]
+        return self.global_ids[self.arrays['doc_term_ids'][start:end]], self.arrays['doc_tfs'][start:end]
+
+    def live_term_counts(self, live: np.ndarray, num_terms: int) -> np.ndarray:
+        """Document frequency of each index-wide term among the live documents"""
+        doc_index = np.repeat(np.arange(self.num_docs), np.diff(self.arrays['doc_offsets']))
+        term_ids = self.global_ids[self.arrays['doc_term_ids'][live[doc_index]]]
+        return np.bincount(term_ids, minlength=num_terms)[:num_terms]
+
+    def save(self, path: Path, terms: List[str]):
+        """Write the segment as .npy arrays plus a JSON sidecar, then map the arrays back from disk"""
+        path.mkdir(parents=True, exist_ok=True)
+        for key in self.ARRAYS:
+            np.save(path / f"{key}.npy", self.arrays[key])
+        with open(path / "meta.json", 'w', encoding='utf-8') as f:
+            json.dump({'first_slot': self.first_slot, 'vocab': [terms[t] for t in self.global_ids],
+                       'ids': self.ids, 'partitions': self.partitions, 'fields': self.fields}, f)
+        self.arrays = {key: np.load(path / f"{key}.npy", mmap_mode='r') for key in self.ARRAYS}
+        self.name = path.name
+
+    @classmethod
+    def load(cls, path: Path) -> "_Segment":
+        """Memory-map a saved segment (unbound until an index adopts it)"""
+        with open(path / "meta.json", 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        arrays = {key: np.load(path / f"{key}.npy", mmap_mode='r') for key in cls.ARRAYS}
+        return cls(meta['first_slot'], meta['vocab'], meta['ids'], meta['partitions'], arrays, name=path.name,
+                   fields=meta['fields'])
+
+
+class BM25Index:
+    """Incremental Okapi BM25 index over postings lists.
+
+    Documents can be added and removed in time proportional to their own
+    length; corpus statistics (document frequencies, total length) are kept
+    as running totals so nothing is rebuilt on upload.
+
+    Every term is stored once, in a vocabulary shared by all segments, and is
+    referred to by integer id elsewhere; per-document and per-term statistics
+    live in typed arrays rather than dicts of strings.
+
+    Flushed documents live in immutable segments that are memory-mapped from
+    disk; newer documents stay in an in-memory tail of contiguous term id
+    buffers until the next flush. Removing a document only sets a tombstone.
+
+    Each document may belong to a partition (its source file). Documents of
+    one source are added together, so a partition is a few slot ranges, and
+    since postings are sorted by slot a filtered query can slice out just
+    those ranges instead of scoring the whole corpus. The FILTER_FIELDS and
+    page of each document are kept in typed arrays too, so filters on them
+    become a slot mask without asking the vector store.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.vocab: Dict[str, int] = {}          # term -> term id
+        self.terms: List[str] = []               # term id -> term
+        self._df = np.zeros(1024, dtype=np.int32)  # term id -> live document frequency
+        self._partition_ids: Dict[str, int] = {}  # partition -> partition id
+        self._partition_names: List[str] = []    # partition id -> partition
+        self._field_ids: Dict[str, Dict] = {field: {} for field in FILTER_FIELDS}      # field -> value -> value id
+        self._field_names: Dict[str, List] = {field: [] for field in FILTER_FIELDS}    # field -> value id -> value
+        self._reset_documents()
+
+    def _reset_documents(self):
+        """Drop every document but keep the vocabulary"""
+        self.doc_ids: List[Optional[str]] = []   # slot -> chunk id (None once removed)
+        self._slots: Dict[str, int] = {}         # chunk id -> slot
+        self._doc_len = np.zeros(1024, dtype=np.int32)  # slot -> token count
+        self._deleted = np.zeros(1024, dtype=bool)      # slot -> tombstone
+        self._num_deleted = 0
+        self._total_len = 0
+        self._df[:] = 0
+        self._partitions = array('i')            # slot -> partition id (-1 for none)
+        self._partition_ranges: Dict[int, List[List[int]]] = {}  # partition id -> [start, end) slot ranges
+        self._partition_sizes: Counter = Counter()  # partition id -> live documents
+        self._fields = {field: array('i') for field in FILTER_FIELDS}  # field -> slot -> value id (-1 for none)
+        self._pages = array('i')                 # slot -> page (-1 for none)
+        self._segments: List[_Segment] = []
+        self._tail_start = 0                     # first slot not yet in a segment
+        self._tail_offsets = array('q', [0])     # tail document -> start in the two buffers below
+        self._tail_term_ids = array('i')
+        self._tail_tfs = array('i')
+        self._postings: Dict[int, Tuple[array, array]] = {}  # term id -> (tail slots, tfs)
+        self._arrays = LRUCache(TERM_CACHE_SIZE)  # term id -> live (slots, tfs)
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self._slots
+
+    def live_ids(self) -> Iterator[str]:
+        return iter(self._slots)
+
+    @property
+    def avgdl(self) -> float:
+        return self._total_len / len(self._slots) if self._slots else 0.0
+
+    def idf(self, term: str) -> float:
+        """Inverse document frequency from the running statistics"""
+        term_id = self.vocab.get(term)
+        df = int(self._df[term_id]) if term_id is not None else 0
+        n = len(self._slots)
+        return math.log(1.0 + (n - df + 0.5) / (df + 0.5))
+
+    def _term_id(self, term: str) -> int:
+        """Id of a term, adding it to the vocabulary on first sight"""
+        term_id = self.vocab.get(term)
+        if term_id is None:
+            term_id = self.vocab[term] = len(self.terms)
+            self.terms.append(term)
+            if term_id >= len(self._df):
+                grown = np.zeros(2 * len(self._df), dtype=np.int32)
+                grown[:len(self._df)] = self._df
+                self._df = grown
+        return term_id
+
+    def _grow(self, size: int):
+        if size > len(self._doc_len):
+            capacity = max(size, 2 * len(self._doc_len))
+            doc_len = np.zeros(capacity, dtype=np.int32)
+            doc_len[:len(self._doc_len)] = self._doc_len
+            deleted = np.zeros(capacity, dtype=bool)
+            deleted[:len(self._deleted)] = self._deleted
+            self._doc_len, self._deleted = doc_len, deleted
+
+    def add(self, doc_ids: List[str], texts: List[str], partitions: List[Optional[str]] = None,
+            metadatas: List[Dict] = None):
+        """Index new documents, optionally tagging each with a partition and its filterable metadata"""
+        if partitions is None:
+            partitions = [None] * len(doc_ids)
+        if metadatas is None:
+            metadatas = [{}] * len(doc_ids)
+        self._arrays.clear()
+        for doc_id, text, partition, metadata in zip(doc_ids, texts, partitions, metadatas):
+            if doc_id in self._slots:
+                self.remove([doc_id])
+
+            tokens = tokenize(text)
+            counts = Counter(tokens)
+            slot = len(self.doc_ids)
+            self._grow(slot + 1)
+
+            self.doc_ids.append(doc_id)
+            self._add_to_partition(partition, slot)
+            self._add_fields(metadata)
+            self._partition_sizes[self._partitions[slot]] += 1
+            self._slots[doc_id] = slot
+            self._doc_len[slot] = len(tokens)
+            self._total_len += len(tokens)
+
+            for term, tf in counts.items():
+                term_id = self._term_id(term)
+                self._df[term_id] += 1
+                self._tail_term_ids.append(term_id)
+                self._tail_tfs.append(tf)
+                postings = self._postings.get(term_id)
+                if postings is None:
+                    postings = self._postings[term_id] = (array('i'), array('i'))
+                postings[0].append(slot)
+                postings[1].append(tf)
+            self._tail_offsets.append(len(self._tail_term_ids))
+
+    def remove(self, doc_ids: List[str]):
+        """Remove documents from the index"""
+        self._arrays.clear()
+        for doc_id in doc_ids:
+            slot = self._slots.pop(doc_id, None)
+            if slot is None:
+                continue
+
+            # Tail postings stay in place; the tombstone hides them until the next flush
+            self._df[self._doc_terms(slot)[0]] -= 1
+            self._deleted[slot] = True
+            self._num_deleted += 1
+            self._total_len -= int(self._doc_len[slot])
+            self._partition_sizes[self._partitions[slot]] -= 1
+            self.doc_ids[slot] = None
+            self._doc_len[slot] = 0
+
+    def clear(self):
+        """Drop every document"""
+        self.__init__(self.k1, self.b)
+
+    def copy(self) -> "BM25Index":
+        """Independent copy to modify while readers keep using this one.
+
+        Flushed segments are immutable and shared; only the in-memory
+        statistics and the tail are copied.
+        """
+        index = copy.copy(self)
+        index.vocab = dict(self.vocab)
+        index.terms = list(self.terms)
+        index._df = self._df.copy()
+        index._partition_ids = dict(self._partition_ids)
+        index._partition_names = list(self._partition_names)
+        index.doc_ids = list(self.doc_ids)
+        index._slots = dict(self._slots)
+        index._doc_len = self._doc_len.copy()
+        index._deleted = self._deleted.copy()
+        index._partitions = array('i', self._partitions)
+        index._partition_ranges = {partition_id: [list(r) for r in ranges]
+                                   for partition_id, ranges in self._partition_ranges.items()}
+        index._partition_sizes = Counter(self._partition_sizes)
+        index._field_ids = {field: dict(values) for field, values in self._field_ids.items()}
+        index._field_names = {field: list(values) for field, values in self._field_names.items()}
+        index._fields = {field: array('i', values) for field, values in self._fields.items()}
+        index._pages = array('i', self._pages)
+        index._segments = list(self._segments)
+        index._tail_offsets = array('q', self._tail_offsets)
+        index._tail_term_ids = array('i', self._tail_term_ids)
+        index._tail_tfs = array('i', self._tail_tfs)
+        index._postings = {term_id: (array('i', slots), array('i', tfs))
+                           for term_id, (slots, tfs) in self._postings.items()}
+        index._arrays = LRUCache(TERM_CACHE_SIZE)
+        return index
+
+    def _add_to_partition(self, partition: Optional[str], slot: int):
+        if partition is None:
+            self._partitions.append(-1)
+            return
+        partition_id = self._partition_ids.get(partition)
+        if partition_id is None:
+            partition_id = self._partition_ids[partition] = len(self._partition_names)
+            self._partition_names.append(partition)
+        self._partitions.append(partition_id)
+
+        ranges = self._partition_ranges.setdefault(partition_id, [])
+        if ranges and ranges[-1][1] == slot:
+            ranges[-1][1] = slot + 1
+        else:
+            ranges.append([slot, slot + 1])
+
+    def _add_fields(self, metadata: Dict):
+        """Append the filterable metadata of the next slot"""
+        for field in FILTER_FIELDS:
+            value = metadata.get(field)
+            if value is None or value == "":
+                self._fields[field].append(-1)
+                continue
+            value_id = self._field_ids[field].get(value)
+            if value_id is None:
+                value_id = self._field_ids[field][value] = len(self._field_names[field])
+                self._field_names[field].append(value)
+            self._fields[field].append(value_id)
+        page = metadata.get(PAGE_FIELD)
+        self._pages.append(int(page) if page is not None else -1)
+
+    def _fields_of(self, slots) -> Dict[str, List]:
+        """Filterable metadata of the given slots, field by field, as stored in segments"""
+        fields = {}
+        for field in FILTER_FIELDS:
+            values, names = self._fields[field], self._field_names[field]
+            fields[field] = [names[values[slot]] if values[slot] >= 0 else None for slot in slots]
+        fields[PAGE_FIELD] = [self._pages[slot] if self._pages[slot] >= 0 else None for slot in slots]
+        return fields
+
+    def allowed_slots(self, filters: Dict) -> Optional[np.ndarray]:
+        """Sorted live slots matching filters on FILTER_FIELDS and page bounds.
+
+        Values are matched exactly, or by membership when a list is given;
+        'page_from' / 'page_to' bound the page. Returns None if a filter
+        names a field the index does not keep.
+        """
+        num_slots = len(self.doc_ids)
+        mask = ~self._deleted[:num_slots]
+        for key, value in filters.items():
+            if key in ('page_from', 'page_to'):
+                pages = np.frombuffer(self._pages, dtype=np.int32)[:num_slots] if num_slots else np.empty(0, np.int32)
+                mask = mask & (pages >= int(value) if key == 'page_from' else (pages >= 0) & (pages <= int(value)))
+            elif key in FILTER_FIELDS:
+                values = value if isinstance(value, (list, tuple, set)) else [value]
+                value_ids = [self._field_ids[key][v] for v in values if v in self._field_ids[key]]
+                stored = (np.frombuffer(self._fields[key], dtype=np.int32)[:num_slots]
+                          if num_slots else np.empty(0, np.int32))
+                mask = mask & np.isin(stored, value_ids)
+            else:
+                return None
+        return np.flatnonzero(mask).astype(np.int32)
+
+    def _partition_of(self, slot: int) -> Optional[str]:
+        partition_id = self._partitions[slot]
+        return self._partition_names[partition_id] if partition_id >= 0 else None
+
+    def partition_ranges(self, partitions: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """Sorted (starts, ends) of the slot ranges covering the given partitions"""
+        partition_ids = [self._partition_ids[p] for p in partitions if p in self._partition_ids]
+        ranges = sorted(r for partition_id in partition_ids for r in self._partition_ranges.get(partition_id, ()))
+        starts = np.array([r[0] for r in ranges], dtype=np.int64)
+        ends = np.array([r[1] for r in ranges], dtype=np.int64)
+        return starts, ends
+
+    def partition_names(self) -> List[str]:
+        """Partitions that still hold live documents"""
+        return sorted(self._partition_names[partition_id] for partition_id, size in self._partition_sizes.items()
+                      if partition_id >= 0 and size > 0)
+
+    def slots_for(self, doc_ids: List[str]) -> np.ndarray:
+        """Sorted slots of the given live documents"""
+        return np.sort(np.fromiter((self._slots[doc_id] for doc_id in doc_ids if doc_id in self._slots),
+                                   dtype=np.int32))
+
+    def _segment_for(self, slot: int) -> _Segment:
+        for segment in self._segments:
+            if segment.first_slot <= slot < segment.first_slot + segment.num_docs:
+                return segment
+        raise KeyError(slot)
+
+    def _doc_terms(self, slot: int) -> Tuple[np.ndarray, np.ndarray]:
+        """(term ids, tfs) of one document, whether flushed or still in the tail"""
+        if slot < self._tail_start:
+            return self._segment_for(slot).doc_terms(slot)
+        local = slot - self._tail_start
+        start, end = self._tail_offsets[local], self._tail_offsets[local + 1]
+        return (np.array(self._tail_term_ids[start:end], dtype=np.int32),
+                np.array(self._tail_tfs[start:end], dtype=np.int32))
+
+    def _term_arrays(self, term_id: int) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """Live postings of a term as (slots, tfs) arrays, cached until the next add or remove"""
+        arrays = self._arrays.get(term_id)
+        if arrays is None:
+            slot_parts, tf_parts = [], []
+            for segment in self._segments:
+                postings = segment.postings(term_id)
+                if postings is not None:
+                    slot_parts.append(postings[0])
+                    tf_parts.append(postings[1])
+
+            tail = self._postings.get(term_id)
+            if tail:
+                slot_parts.append(np.array(tail[0], dtype=np.int32))
+                tf_parts.append(np.array(tail[1], dtype=np.float32))
+            if not slot_parts:
+                return None
+
+            # A term found in a single segment is scored straight from the mapped file
+            slots = slot_parts[0] if len(slot_parts) == 1 else np.concatenate(slot_parts)
+            tfs = tf_parts[0] if len(tf_parts) == 1 else np.concatenate(tf_parts)
+            if self._num_deleted:
+                live = ~self._deleted[slots]
+                if not live.all():
+                    slots, tfs = slots[live], tfs[live]
+            arrays = (slots, tfs)
+            self._arrays.put(term_id, arrays)
+        return arrays if len(arrays[0]) else None
+
+    def _term_scores(self, term: str, avgdl: float, ranges: Tuple[np.ndarray, np.ndarray] = None,
+                     allowed: np.ndarray = None) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """BM25 contribution of one term to each document in its postings.
+
+        ranges restricts scoring to those slot ranges (postings are sorted by
+        slot, so they are sliced out by binary search); allowed further keeps
+        only the given sorted slots.
+        """
+        term_id = self.vocab.get(term)
+        arrays = self._term_arrays(term_id) if term_id is not None else None
+        if arrays is None:
+            return None
+        slots, tfs = arrays
+        if ranges is not None:
+            bounds = zip(np.searchsorted(slots, ranges[0]), np.searchsorted(slots, ranges[1]))
+            pieces = [(start, end) for start, end in bounds if end > start]
+            slots = np.concatenate([slots[start:end] for start, end in pieces] or [slots[:0]])
+            tfs = np.concatenate([tfs[start:end] for start, end in pieces] or [tfs[:0]])
+        if allowed is not None:
+            keep = np.isin(slots, allowed, assume_unique=True)
+            slots, tfs = slots[keep], tfs[keep]
+        if not len(slots):
+            return None
+        norm = self.k1 * (1 - self.b + self.b * self._doc_len[slots] / avgdl)
+        return slots, self.idf(term) * tfs * (self.k1 + 1) / (tfs + norm)
+
+    def get_scores(self, query_tokens: List[str]) -> np.ndarray:
+        """Score every slot against the query (removed slots score 0)"""
+        scores = np.zeros(len(self.doc_ids))
+        if not self._slots:
+            return scores
+
+        avgdl = self.avgdl
+        for term in query_tokens:
+            term_scores = self._term_scores(term, avgdl)
+            if term_scores is not None:
+                slots, contribution = term_scores
+                scores[slots] += contribution
+        return scores
+
+    def top_k(self, query_tokens: List[str], k: int, partitions: List[str] = None,
+              allowed: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Best k (slots, scores), touching only the postings of the query terms.
+
+        partitions limits the search to documents of those partitions and
+        allowed (sorted slots) to an explicit subset; corpus statistics stay global.
+        """
+        empty = (np.empty(0, dtype=np.int32), np.empty(0))
+        if not self._slots or k <= 0:
+            return empty
+
+        ranges = self.partition_ranges(partitions) if partitions is not None else None
+        if ranges is not None and not len(ranges[0]):
+            return empty
+
+        avgdl = self.avgdl
+        slot_parts, score_parts = [], []
+        for term, qtf in Counter(query_tokens).items():
+            term_scores = self._term_scores(term, avgdl, ranges, allowed)
+            if term_scores is not None:
+                slot_parts.append(term_scores[0])
+                score_parts.append(qtf * term_scores[1])
+        if not slot_parts:
+            return empty
+
+        slots = np.concatenate(slot_parts)
+        scores = np.concatenate(score_parts).astype(np.float64)
+        if len(slot_parts) > 1:
+            slots, inverse = np.unique(slots, return_inverse=True)
+            scores = np.bincount(inverse, weights=scores)
+
+        if k < len(slots):
+            top = np.argpartition(-scores, k - 1)[:k]
+            slots, scores = slots[top], scores[top]
+        order = np.argsort(-scores, kind="stable")
+        return slots[order], scores[order]
+
+    def top_k_batch(self, queries: List[List[str]], k: int, partitions: List[str] = None,
+                    allowed: np.ndarray = None) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """top_k for several tokenized queries at once.
+
+        Each distinct term's postings are scored once however many queries
+        contain it, and the contributions of all queries are summed and ranked
+        together, keyed by (query, slot).
+        """
+        empty = (np.empty(0, dtype=np.int32), np.empty(0))
+        results = [empty] * len(queries)
+        if not self._slots or k <= 0:
+            return results
+
+        ranges = self.partition_ranges(partitions) if partitions is not None else None
+        if ranges is not None and not len(ranges[0]):
+            return results
+
+        avgdl = self.avgdl
+        term_scores = {}
+        query_parts, slot_parts, score_parts = [], [], []
+        for q, query_tokens in enumerate(queries):
+            for term, qtf in Counter(query_tokens).items():
+                if term not in term_scores:
+                    term_scores[term] = self._term_scores(term, avgdl, ranges, allowed)
+                if term_scores[term] is not None:
+                    slots, scores = term_scores[term]
+                    query_parts.append(np.full(len(slots), q, dtype=np.int64))
+                    slot_parts.append(slots)
+                    score_parts.append(qtf * scores)
+        if not slot_parts:
+            return results
+
+        num_slots = len(self.doc_ids)
+        keys = np.concatenate(query_parts) * num_slots + np.concatenate(slot_parts)
+        keys, inverse = np.unique(keys, return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(score_parts).astype(np.float64))
+        query_ids, slots = np.divmod(keys, num_slots)
+
+        # Grouped by query, best first within each group
+        order = np.lexsort((-scores, query_ids))
+        bounds = np.searchsorted(query_ids[order], np.arange(len(queries) + 1))
+        for q in range(len(queries)):
+            top = order[bounds[q]:min(bounds[q] + k, bounds[q + 1])]
+            if len(top):
+                results[q] = (slots[top].astype(np.int32), scores[top])
+        return results
+
+    def memory_usage(self) -> Dict[str, int]:
+        """Approximate bytes held by each part of the index; mapped segment files are counted separately"""
+        vocabulary = (sys.getsizeof(self.vocab) + sys.getsizeof(self.terms)
+                      + sum(sys.getsizeof(term) for term in self.terms))
+        doc_ids = (sys.getsizeof(self.doc_ids) + sys.getsizeof(self._slots)
+                   + sum(sys.getsizeof(doc_id) for doc_id in self._slots))
+        statistics = (_nbytes(self._df) + _nbytes(self._doc_len) + _nbytes(self._deleted) + _nbytes(self._partitions)
+                      + _nbytes(self._pages) + sum(_nbytes(values) for values in self._fields.values()))
+        tail = (_nbytes(self._tail_offsets) + _nbytes(self._tail_term_ids) + _nbytes(self._tail_tfs)
+                + sys.getsizeof(self._postings)
+                + sum(_nbytes(slots) + _nbytes(tfs) for slots, tfs in self._postings.values()))
+
+        segments = mapped = 0
+        for segment in self._segments:
+            segments += _nbytes(segment.global_ids) + _nbytes(segment._order) + _nbytes(segment._sorted_ids)
+            for values in segment.arrays.values():
+                if isinstance(values, np.memmap):
+                    mapped += _nbytes(values)
+                else:
+                    segments += _nbytes(values)
+
+        return {
+            'terms': len(self.terms),
+            'vocabulary_bytes': vocabulary,
+            'doc_id_bytes': doc_ids,
+            'statistics_bytes': statistics,
+            'tail_bytes': tail,
+            'segment_bytes': segments,
+            'mapped_bytes': mapped,
+            'total_bytes': vocabulary + doc_ids + statistics + tail + segments
+        }
+
+    def _compact(self):
+        """Merge every segment and the tail into one segment of live documents"""
+        live_slots = [slot for slot, doc_id in enumerate(self.doc_ids) if doc_id is not None]
+        doc_terms = [self._doc_terms(slot) for slot in live_slots]
+        doc_offsets = np.zeros(len(live_slots) + 1, dtype=np.int64)
+        np.cumsum([len(term_ids) for term_ids, _ in doc_terms], out=doc_offsets[1:])
+        segment = _Segment.build(
+            0,
+            [self.doc_ids[slot] for slot in live_slots],
+            doc_offsets,
+            np.concatenate([term_ids for term_ids, _ in doc_terms] or [np.empty(0, dtype=np.int32)]),
+            np.concatenate([tfs for _, tfs in doc_terms] or [np.empty(0, dtype=np.int32)]),
+            [self._partition_of(slot) for slot in live_slots],
+            self._fields_of(live_slots)
+        )
+        self._reset_documents()
+        self._adopt(segment)
+
+    def _adopt(self, segment: _Segment, deleted: np.ndarray = None):
+        """Append a segment whose slots start right after the current ones.
+
+        deleted lists slots of the segment removed since it was written; they
+        are tombstoned here and never mapped to their chunk id, which a newer
+        segment may hold again.
+        """
+        if segment.global_ids is None:
+            segment.bind(np.fromiter((self._term_id(term) for term in segment.vocab),
+                                     dtype=np.int32, count=len(segment.vocab)))
+        end = segment.first_slot + segment.num_docs
+        doc_len = np.asarray(segment.arrays['doc_len'])
+        self._grow(end)
+        self._doc_len[segment.first_slot:end] = doc_len
+
+        ids = list(segment.ids)
+        if deleted is not None:
+            for slot in deleted:
+                ids[slot - segment.first_slot] = None
+
+        for offset, (doc_id, partition) in enumerate(zip(ids, segment.partitions)):
+            slot = segment.first_slot + offset
+            self._add_to_partition(partition, slot)
+            self._add_fields({field: values[offset] for field, values in segment.fields.items()})
+            if doc_id is None:
+                self._deleted[slot] = True
+                self._num_deleted += 1
+                self._doc_len[slot] = 0
+            else:
+                self._slots[doc_id] = slot
+                self._total_len += int(doc_len[offset])
+                self._partition_sizes[self._partitions[slot]] += 1
+
+        live = np.array([doc_id is not None for doc_id in ids], dtype=bool)
+        self._df[:len(self.terms)] += segment.live_term_counts(live, len(self.terms)).astype(np.int32)
+        self.doc_ids.extend(ids)
+        self._segments.append(segment)
+        self._tail_start = end
+        self._arrays.clear()
+
+    def flush(self, directory: Path):
+        """Persist the index: write the tail as a new segment and update the manifest"""
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+
+        num_slots = len(self.doc_ids)
+        too_fragmented = len(self._segments) >= MAX_SEGMENTS
+        too_many_deleted = self._num_deleted > MAX_DELETED_FRACTION * max(num_slots, 1)
+
+        if too_fragmented or too_many_deleted:
+            self._compact()
+            self._segments[0].save(directory / self._next_segment_name(directory), self.terms)
+        elif num_slots > self._tail_start:
+            slots = range(self._tail_start, num_slots)
+            segment = _Segment.build(
+                self._tail_start,
+                [self.doc_ids[slot] for slot in slots],
+                self._tail_offsets,
+                self._tail_term_ids,
+                self._tail_tfs,
+                [self._partition_of(slot) for slot in slots],
+                self._fields_of(slots)
+            )
+            segment.save(directory / self._next_segment_name(directory), self.terms)
+            self._segments.append(segment)
+            self._tail_start = num_slots
+            self._tail_offsets = array('q', [0])
+            self._tail_term_ids = array('i')
+            self._tail_tfs = array('i')
+            self._postings = {}
+            self._arrays.clear()
+
+        manifest = {
+            'format': SNAPSHOT_FORMAT,
+            'k1': self.k1,
+            'b': self.b,
+            'segments': [segment.name for segment in self._segments],
+            'deleted': np.flatnonzero(self._deleted[:num_slots]).tolist(),
+        }
+        tmp_path = directory / "manifest.json.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, directory / "manifest.json")
+
+        referenced = set(manifest['segments'])
+        for path in directory.glob("seg_*"):
+            if path.name not in referenced:
+                shutil.rmtree(path, ignore_errors=True)
+
+    @staticmethod
+    def _next_segment_name(directory: Path) -> str:
+        existing = [int(p.name[4:]) for p in directory.glob("seg_*") if p.name[4:].isdigit()]
+        return f"seg_{max(existing, default=-1) + 1:06d}"
+
+    @classmethod
+    def load(cls, directory: Path) -> Optional["BM25Index"]:
+        """Memory-map a flushed index, or return None if there is no usable snapshot"""
+        manifest_path = Path(directory) / "manifest.json"
+        if not manifest_path.exists():
+            return None
+
+        try:
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            if manifest.get('format') != SNAPSHOT_FORMAT:
+                return None
+
+            index = cls(manifest['k1'], manifest['b'])
+            deleted = np.array(manifest['deleted'], dtype=np.int64)
+            for name in manifest['segments']:
+                segment = _Segment.load(Path(directory) / name)
+                end = segment.first_slot + segment.num_docs
+                index._adopt(segment, deleted[(deleted >= segment.first_slot) & (deleted < end)])
+            return index
+        except (OSError, ValueError, KeyError, IndexError) as e:
+            print(f"Could not load BM25 snapshot: {str(e)}", end="\n")
+            return None
@@ -0,0 +1,239 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Hashable, List, Optional
+import numpy as np
+
+
+def normalize_query(text: str) -> str:
+    """Canonical form of a query used as a cache key"""
+    return " ".join(text.lower().split())
+
+
+def hash_text(text: str) -> str:
+    """Content hash identifying a chunk"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class LRUCache:
+    """Thread-safe bounded mapping that evicts the least recently used entry"""
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key: Hashable, value: Any):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses}
+
+
+class AnswerCache:
+    """Semantic cache of generated answers.
+
+    An entry is reused when the student level and the retrieved context are
+    identical and the query embedding is within a cosine-similarity threshold.
+    Entries expire after a TTL, the least recently used are evicted first, and
+    new entries are appended to a JSON-lines file so the cache survives restarts.
+    """
+
+    def __init__(self, path: Path, threshold: float = 0.95, ttl: float = 7 * 24 * 3600, maxsize: int = 1000):
+        self.path = Path(path)
+        self.threshold = threshold
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()   # entry id -> entry, least recently used first
+        self._groups = {}               # (level, context hash) -> set of entry ids
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    @staticmethod
+    def hash_context(chunks: List[str]) -> str:
+        digest = hashlib.sha256()
+        for chunk in chunks:
+            digest.update(chunk.encode('utf-8'))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def lookup(self, embedding: List[float], level: str, context_hash: str) -> Optional[Dict]:
+        """Most similar live entry for the same level and context, if close enough"""
+        query = self._normalize(embedding)
+        now = time.time()
+        with self._lock:
+            entry_ids = [
+                entry_id for entry_id in self._groups.get((level, context_hash), ())
+                if now - self._entries[entry_id]['created'] <= self.ttl
+            ]
+            if entry_ids:
+                matrix = np.stack([self._entries[entry_id]['embedding'] for entry_id in entry_ids])
+                similarities = matrix @ query
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    self._entries.move_to_end(entry_ids[best])
+                    self.hits += 1
+                    entry = self._entries[entry_ids[best]]
+                    return {'answer': entry['answer'], 'complexity': entry['complexity'],
+                            'similarity': float(similarities[best])}
+            self.misses += 1
+            return None
+
+    def put(self, embedding: List[float], level: str, context_hash: str, answer: str, complexity: str):
+        """Cache an answer and append it to the backing file"""
+        record = {
+            'embedding': [float(x) for x in embedding],
+            'level': level,
+            'context_hash': context_hash,
+            'answer': answer,
+            'complexity': complexity,
+            'created': time.time()
+        }
+        with self._lock:
+            self._insert(record)
+            try:
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(record) + "\n")
+            except OSError as e:
+                print(f"Could not persist answer cache entry: {str(e)}", end="\n")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._groups.clear()
+            self.path.unlink(missing_ok=True)
+
+    def stats(self) -> Dict[str, int]:
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def _insert(self, record: Dict):
+        entry = dict(record, embedding=self._normalize(record['embedding']))
+        group = (record['level'], record['context_hash'])
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = entry
+        self._groups.setdefault(group, set()).add(entry_id)
+
+        while len(self._entries) > self.maxsize:
+            old_id, old = self._entries.popitem(last=False)
+            old_group = (old['level'], old['context_hash'])
+            self._groups[old_group].discard(old_id)
+            if not self._groups[old_group]:
+                del self._groups[old_group]
+
+    def _load(self):
+        """Read live entries back and compact the backing file"""
+        if not self.path.exists():
+            return
+        now = time.time()
+        records = []
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if now - record['created'] <= self.ttl:
+                        records.append(record)
+            records = records[-self.maxsize:]
+            for record in records:
+                self._insert(record)
+
+            tmp_path = self.path.with_suffix(self.path.suffix + ".tmp")
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for record in records:
+                    f.write(json.dumps(record) + "\n")
+            os.replace(tmp_path, self.path)
+            print(f"Answer cache loaded ({len(self._entries)} entries)", end="\n")
+        except (OSError, KeyError) as e:
+            print(f"Could not load answer cache: {str(e)}", end="\n")
+
+
+class EmbeddingCache:
+    """Persistent embeddings keyed by (model name, chunk hash) in a SQLite file"""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT NOT NULL, chunk_hash TEXT NOT NULL, vector BLOB NOT NULL, "
+            "PRIMARY KEY (model, chunk_hash))"
+        )
+        self._conn.commit()
+        # Counted once here and kept up to date by put_many, so stats() never scans the table
+        self.size = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def get_many(self, model: str, chunk_hashes: List[str]) -> Dict[str, List[float]]:
+        """Cached embeddings for whichever of the hashes are present"""
+        found = {}
+        with self._lock:
+            # Stay well below SQLite's limit on query parameters
+            for start in range(0, len(chunk_hashes), 500):
+                batch = chunk_hashes[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT chunk_hash, vector FROM embeddings WHERE model = ? "
+                    f"AND chunk_hash IN ({', '.join('?' * len(batch))})",
+                    [model, *batch]
+                ).fetchall()
+                for chunk_hash, vector in rows:
+                    found[chunk_hash] = np.frombuffer(vector, dtype=np.float32).tolist()
+            self.hits += len(found)
+            self.misses += len(set(chunk_hashes)) - len(found)
+        return found
+
+    def put_many(self, model: str, chunk_hashes: List[str], embeddings: List[List[float]]):
+        with self._lock:
+            # A chunk hash always embeds to the same vector under one model, so existing rows are kept
+            cursor = self._conn.executemany(
+                "INSERT OR IGNORE INTO embeddings (model, chunk_hash, vector) VALUES (?, ?, ?)",
+                [(model, chunk_hash, np.asarray(embedding, dtype=np.float32).tobytes())
+                 for chunk_hash, embedding in zip(chunk_hashes, embeddings)]
+            )
+            self._conn.commit()
+            self.size += max(cursor.rowcount, 0)
+
+    def stats(self) -> Dict[str, int]:
+        return {'size': self.size, 'hits': self.hits, 'misses': self.misses}
@@ -1,12 +1,31 @@
 import os
 from pathlib import Path
 
+
+def available_cpus() -> int:
+    """CPUs this process may use: its affinity mask, capped by a cgroup v2 CPU quota (e.g. a compose cpus limit)"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max", 'r') as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpus = min(cpus, max(int(quota) // int(period), 1))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
 # Directories
 BASE_DIR = Path(__file__).parent
 DATA_DIR = BASE_DIR / "data"
 UPLOADS_DIR = BASE_DIR / "uploads"
 MODELS_DIR = BASE_DIR / "models"
 CHROMA_DB_DIR = DATA_DIR / "chroma_db"
+BM25_INDEX_DIR = DATA_DIR / "bm25_index"
+FLAT_INDEX_DIR = DATA_DIR / "flat_index"
 CONVERSATIONS_DIR = DATA_DIR / "conversations"
 
 # Ensure directories exist
@@ -14,20 +33,109 @@ DATA_DIR.mkdir(exist_ok=True, parents=True)
 UPLOADS_DIR.mkdir(exist_ok=True, parents=True)
 MODELS_DIR.mkdir(exist_ok=True, parents=True)
 CHROMA_DB_DIR.mkdir(exist_ok=True, parents=True)
+BM25_INDEX_DIR.mkdir(exist_ok=True, parents=True)
 CONVERSATIONS_DIR.mkdir(exist_ok=True, parents=True)
 
 # Embedding Model Configuration
 EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+EMBED_TOKEN_BUDGET = 8192  # Padded tokens per encode batch (batch size x longest text)
+EMBED_MAX_BATCH = 128
+
+# Embedding Backend Configuration
+EMBEDDING_BACKEND = "torch"  # "torch" (sentence-transformers) or "onnx" (run export_onnx_model.py first)
+ONNX_MODEL_DIR = MODELS_DIR / "all-MiniLM-L6-v2-onnx"
+ONNX_QUANTIZED = True  # Use the int8 model rather than the float32 export
+EMBEDDING_PARITY_MIN_COSINE = 0.99  # Minimum per-text cosine to the PyTorch embeddings
+
+# Embedding Pool Configuration
+USE_EMBEDDING_POOL = False  # Each worker loads its own copy of the model; enable only with memory to spare
+EMBEDDING_POOL_WORKERS = min(max(available_cpus() // 2, 1), 2)  # A single worker disables the pool
+EMBEDDING_POOL_MIN_TEXTS = 128  # Smaller batches are embedded in-process
+
+# Embedding Cache Configuration
+USE_EMBEDDING_CACHE = True
+EMBEDDING_CACHE_PATH = DATA_DIR / "embedding_cache.sqlite3"
 
 # Chunking Configuration
+CHUNKING_MODE = "tokens"  # "tokens" (embedding tokenizer) or "characters" (CHUNK_SIZE/CHUNK_OVERLAP)
 CHUNK_SIZE = 1000
 CHUNK_OVERLAP = 200
+EMBEDDING_MAX_TOKENS = 256  # Input length after which the embedding model truncates
+CHUNK_TOKEN_OVERLAP = 32
+
+# PDF Extraction Configuration
+PDF_WORKERS = min(available_cpus(), 4)  # Each worker is a separate process holding its own PDF reader
+PDF_PARALLEL_MIN_PAGES = 40  # Smaller PDFs are extracted in-process
+
+# Streaming Ingestion Configuration
+STREAM_CHUNK_BUFFER = 20000  # Characters of page text buffered before chunking
+INGEST_BATCH_SIZE = 256  # Chunks embedded and written per batch
+INGEST_QUEUE_BATCHES = 2  # Batches prepared ahead of the embedder
+
+# Ingestion Job Configuration
+INGEST_JOBS_DIR = DATA_DIR / "ingest_jobs"  # Checkpoints of queued and running uploads
+INGEST_JOB_WORKERS = 1  # Uploads processed at once (writes to the index are serialized anyway)
+INGEST_JOB_MAX_ATTEMPTS = 3  # Runs of an interrupted job before it is given up
+INGEST_PROGRESS_INTERVAL = 0.5  # Seconds between progress updates streamed to the UI
+
+# Vector Index Configuration
+VECTOR_INDEX = "chroma"  # "chroma" (HNSW + SQLite) or "flat" (exact search over a memory-mapped matrix)
+FLAT_INDEX_DTYPE = "float16"  # "float16" or "int8" (per-row scaled)
 
 # Retrieval Configuration
 USE_HYBRID_SEARCH = True
 HYBRID_ALPHA = 0.5
+FUSION_METHOD = "linear"  # "linear" (HYBRID_ALPHA mix) or "rrf" (reciprocal rank fusion)
+RRF_K = 60
 USE_RERANKING = True
 RERANK_TOP_K = 10
+RERANK_MODEL = "ms-marco-MiniLM-L-12-v2"  # Lighter: "ms-marco-TinyBERT-L-2-v2"; multilingual: "ms-marco-MultiBERT-L-12"
+RERANK_CACHE_SIZE = 4096  # Cached (query, chunk) scores
+RERANK_SKIP_MARGIN = 0.15  # Skip the cross-encoder when the fused score gap after the top results is this large (None to always rerank)
+RERANK_LATENCY_BUDGET_MS = 150  # Cross-encoder time per query; fewer passages are scored when it would be exceeded (None for no limit)
+BM25_REBUILD_BATCH = 5000
+
+# Query Cache Configuration
+QUERY_EMBEDDING_CACHE_SIZE = 1024
+RETRIEVAL_CACHE_SIZE = 256
+
+# LLM Client Configuration
+OLLAMA_HOST = os.getenv("OLLAMA_HOST")  # None uses the ollama library default
+LLM_REQUEST_TIMEOUT = 180.0  # Seconds per request (between chunks when streaming)
+LLM_MAX_CONNECTIONS = 8
+MODEL_CONCURRENCY = {
+    "phi3:mini": 4,
+    "mistral:7b": 1,
+}
+DEFAULT_MODEL_CONCURRENCY = 2
+
+# Model Residency Configuration
+MODEL_RESIDENCY_POLICY = "all"  # "all" (warm both), "pin_small" (small pinned, large lazy) or "lazy"
+MODEL_KEEP_ALIVE = {  # Seconds Ollama keeps an idle model loaded
+    "phi3:mini": 1800,
+    "mistral:7b": 600,
+}
+DEFAULT_KEEP_ALIVE = 300
+RESIDENCY_REFRESH_INTERVAL = 10.0  # Seconds between checks of Ollama's loaded models
+
+# Model Routing Configuration
+LOAD_AWARE_ROUTING = True
+ROUTING_LATENCY_SLO = 30.0  # Target p95 seconds per answer of ROUTING_ANSWER_TOKENS tokens
+ROUTING_ANSWER_TOKENS = 200  # Answer length latencies are normalized to before comparing
+ROUTING_SAMPLE_MAX_AGE = 600.0  # Seconds after which a latency sample no longer counts
+ROUTING_PROBE_INTERVAL = 120.0  # Seconds between complex queries sent to a degraded large model
+ROUTING_DEFAULT_LATENCY = {  # Priors used until latencies have been measured (or once they age out)
+    "phi3:mini": 8.0,
+    "mistral:7b": 25.0,
+}
+ROUTING_PROMOTE_SIMPLE = True
+
+# Answer Cache Configuration
+ANSWER_CACHE_ENABLED = True
+ANSWER_CACHE_PATH = DATA_DIR / "answer_cache.jsonl"
+ANSWER_CACHE_THRESHOLD = 0.95  # Minimum cosine similarity between query embeddings
+ANSWER_CACHE_TTL = 7 * 24 * 3600  # Seconds
+ANSWER_CACHE_SIZE = 1000
 
 # Device Configuration , GPU support will be added in future updates
 DEVICE = "cpu"
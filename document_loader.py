@@ -1,42 +1,132 @@
+import hashlib
 import os
-from typing import List, Dict
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Dict
 from pathlib import Path
 import pypdf
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from config import CHUNK_SIZE, CHUNK_OVERLAP
+from config import (EMBEDDING_MODEL, CHUNKING_MODE, CHUNK_SIZE, CHUNK_OVERLAP,
+                   EMBEDDING_MAX_TOKENS, CHUNK_TOKEN_OVERLAP,
+                   PDF_WORKERS, PDF_PARALLEL_MIN_PAGES, STREAM_CHUNK_BUFFER)
+
+try:
+    from transformers import AutoTokenizer
+    TRANSFORMERS_AVAILABLE = True
+except ImportError:
+    TRANSFORMERS_AVAILABLE = False
+    print("transformers not available, falling back to character chunking", end="\n")
+
+
+def _extract_page_range(file_path: str, start: int, end: int) -> List[str]:
+    """Extract the text of pages [start, end) (runs in a worker process)"""
+    with open(file_path, 'rb') as file:
+        pdf_reader = pypdf.PdfReader(file)
+        return [pdf_reader.pages[i].extract_text() or "" for i in range(start, end)]
+
 
 class DocumentLoader:
-    def __init__(self, chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP):
-        self.chunk_size = chunk_size
-        self.chunk_overlap = chunk_overlap
+    def __init__(self, chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP,
+                 chunking_mode: str = CHUNKING_MODE):
+        self.tokenizer = self._load_tokenizer()
+        
+        # Token chunks are packed up to the embedding model's real input limit. Pieces are
+        # measured without [CLS]/[SEP], which the model adds once per chunk, not per piece
+        if chunking_mode == "tokens" and self.tokenizer is not None:
+            self.chunking_mode = "tokens"
+            self.chunk_size = EMBEDDING_MAX_TOKENS - self.tokenizer.num_special_tokens_to_add()
+            self.chunk_overlap = CHUNK_TOKEN_OVERLAP
+            length_function = lambda text: self.count_tokens(text, add_special_tokens=False)
+        else:
+            self.chunking_mode = "characters"
+            self.chunk_size = chunk_size
+            self.chunk_overlap = chunk_overlap
+            length_function = len
+        
         self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=chunk_size,
-            chunk_overlap=chunk_overlap,
-            length_function=len,
+            chunk_size=self.chunk_size,
+            chunk_overlap=self.chunk_overlap,
+            length_function=length_function,
             separators=["\n\n", "\n", " ", ""]
         )
-        print("DocumentLoader initialized", end="\n")
+        print(f"DocumentLoader initialized ({self.chunking_mode} chunking, "
+              f"size {self.chunk_size}, overlap {self.chunk_overlap})", end="\n")
+    
+    @staticmethod
+    def _load_tokenizer():
+        """Tokenizer of the embedding model, or None when it cannot be loaded"""
+        if not TRANSFORMERS_AVAILABLE:
+            return None
+        try:
+            return AutoTokenizer.from_pretrained(EMBEDDING_MODEL)
+        except Exception as e:
+            print(f"Could not load tokenizer for {EMBEDDING_MODEL}: {str(e)}", end="\n")
+            return None
+    
+    def count_tokens(self, text: str, add_special_tokens: bool = True) -> int:
+        """Length of text as seen by the embedding model, special tokens included unless disabled"""
+        return len(self.tokenizer(text, add_special_tokens=add_special_tokens, truncation=False,
+                                  verbose=False)['input_ids'])
     
     def load_pdf(self, file_path: str) -> str:
         """Extract text from PDF file"""
+        try:
+            return "\n".join(self.load_pdf_pages(file_path))
+        except Exception:
+            return ""
+    
+    def load_pdf_pages(self, file_path: str) -> List[str]:
+        """Extract the text of each PDF page"""
+        return list(self.iter_pdf_pages(file_path))
+    
+    def iter_pdf_pages(self, file_path: str) -> Iterator[str]:
+        """Yield PDF page texts in order, fanning page ranges out to worker processes.
+        
+        Extraction errors are re-raised, so a PDF that fails partway through
+        is never mistaken for a shorter document.
+        """
         print(f"Loading PDF: {file_path}", end="\n")
-        text = ""
         try:
             with open(file_path, 'rb') as file:
-                pdf_reader = pypdf.PdfReader(file)
-                total_pages = len(pdf_reader.pages)
-                print(f"Total pages: {total_pages}", end="\n")
+                total_pages = len(pypdf.PdfReader(file).pages)
+            print(f"Total pages: {total_pages}", end="\n")
+            
+            total_chars = 0
+            workers = min(PDF_WORKERS, total_pages)
+            if workers <= 1 or total_pages < PDF_PARALLEL_MIN_PAGES:
+                for page in _extract_page_range(file_path, 0, total_pages):
+                    total_chars += len(page)
+                    yield page
+            else:
+                # Several small ranges per worker keep the pool busy when pages differ in cost
+                range_size = -(-total_pages // (workers * 4))
+                starts = list(range(0, total_pages, range_size))
+                ends = [min(start + range_size, total_pages) for start in starts]
                 
-                for page_num, page in enumerate(pdf_reader.pages):
-                    text += page.extract_text()
-                    if (page_num + 1) % 10 == 0:
-                        print(f"Processed {page_num + 1}/{total_pages} pages", end="\n")
-                
-            print(f"PDF loaded successfully. Total characters: {len(text)}", end="\n")
-            return text
+                processed = 0
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    for page_texts in executor.map(_extract_page_range, [file_path] * len(starts), starts, ends):
+                        processed += len(page_texts)
+                        print(f"Processed {processed}/{total_pages} pages", end="\n")
+                        for page in page_texts:
+                            total_chars += len(page)
+                            yield page
+            
+            print(f"PDF loaded successfully. Total characters: {total_chars}", end="\n")
         except Exception as e:
             print(f"Error loading PDF: {str(e)}", end="\n")
-            return ""
+            raise
+    
+    def count_pages(self, file_path: str) -> int:
+        """Number of pages iter_document_pages will yield (a TXT file is one page)"""
+        if Path(file_path).suffix.lower() != '.pdf':
+            return 1
+        try:
+            with open(file_path, 'rb') as file:
+                return len(pypdf.PdfReader(file).pages)
+        except Exception as e:
+            print(f"Error reading PDF: {str(e)}", end="\n")
+            return 0
     
     def load_txt(self, file_path: str) -> str:
         """Load text from TXT file"""
@@ -52,15 +142,24 @@ class DocumentLoader:
     
     def load_document(self, file_path: str) -> str:
         """Load document based on file extension"""
+        return "\n".join(self.load_document_pages(file_path))
+    
+    def load_document_pages(self, file_path: str) -> List[str]:
+        """Load document as a list of page texts (a TXT file is a single page)"""
+        return list(self.iter_document_pages(file_path))
+    
+    def iter_document_pages(self, file_path: str) -> Iterator[str]:
+        """Yield page texts based on file extension"""
         file_ext = Path(file_path).suffix.lower()
         
         if file_ext == '.pdf':
-            return self.load_pdf(file_path)
+            yield from self.iter_pdf_pages(file_path)
         elif file_ext == '.txt':
-            return self.load_txt(file_path)
+            text = self.load_txt(file_path)
+            if text:
+                yield text
         else:
             print(f"Unsupported file type: {file_ext}", end="\n")
-            return ""
     
     def chunk_text(self, text: str) -> List[str]:
         """Split text into chunks"""
@@ -69,28 +168,99 @@ class DocumentLoader:
         print(f"Created {len(chunks)} chunks", end="\n")
         return chunks
     
-    def process_document(self, file_path: str) -> List[Dict[str, str]]:
-        """Process document and return chunks with metadata"""
-        text = self.load_document(file_path)
-        if not text:
-            return []
+    @staticmethod
+    def hash_file(file_path: str) -> str:
+        """SHA-256 of the file contents, used to recognise re-uploads"""
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+    
+    def iter_documents(self, file_path: str, file_hash: str = None, extra_metadata: Dict = None) -> Iterator[Dict]:
+        """Stream chunks with metadata as pages are extracted.
         
-        chunks = self.chunk_text(text)
+        extra_metadata (e.g. subject, class_name, uploader) is attached to
+        every chunk so retrieval can be filtered by it; empty values are dropped.
         
-        # Create documents with metadata
-        documents = []
+        Pages accumulate in a buffer; once it holds STREAM_CHUNK_BUFFER
+        characters it is split and every chunk except the last is emitted.
+        The last, possibly incomplete, chunk is carried over and re-split
+        together with the following pages.
+        """
         filename = Path(file_path).name
+        file_hash = file_hash or self.hash_file(file_path)
+        extra_metadata = {key: value for key, value in (extra_metadata or {}).items() if value not in (None, "")}
+        buffer = ""
+        buffer_start = 0   # offset of buffer[0] in the whole document
+        page_starts = []   # offset at which each page starts
+        next_id = 0
+        token_stats = {'tokens': 0, 'max_tokens': 0, 'truncated_chunks': 0, 'truncated_tokens': 0}
         
-        for idx, chunk in enumerate(chunks):
-            documents.append({
-                'text': chunk,
-                'metadata': {
-                    'source': filename,
-                    'chunk_id': idx,
-                    'total_chunks': len(chunks),
-                    'type': 'text'
+        def split(final: bool):
+            nonlocal buffer, buffer_start, next_id
+            chunks = self.text_splitter.split_text(buffer)
+            
+            starts = []
+            cursor = 0
+            for chunk in chunks:
+                start = buffer.find(chunk, cursor)
+                if start < 0:
+                    start = cursor
+                starts.append(start)
+                cursor = start + 1
+            
+            emit = len(chunks) if final else max(len(chunks) - 1, 0)
+            for chunk, start in zip(chunks[:emit], starts[:emit]):
+                if self.tokenizer is not None:
+                    self._record_tokens(token_stats, self.count_tokens(chunk))
+                yield {
+                    'text': chunk,
+                    'metadata': {
+                        'source': filename,
+                        'chunk_id': next_id,
+                        'page': bisect_right(page_starts, buffer_start + start),
+                        'file_hash': file_hash,
+                        'type': 'text',
+                        **extra_metadata
+                    }
                 }
-            })
+                next_id += 1
+            
+            if emit < len(chunks):
+                buffer_start += starts[emit]
+                buffer = buffer[starts[emit]:]
+        
+        for page in self.iter_document_pages(file_path):
+            if page_starts:
+                buffer += "\n"
+            page_starts.append(buffer_start + len(buffer))
+            buffer += page
+            
+            if len(buffer) >= STREAM_CHUNK_BUFFER:
+                yield from split(final=False)
+        
+        if buffer.strip():
+            yield from split(final=True)
         
-        print(f"Document processing complete: {len(documents)} document chunks created", end="\n")
+        print(f"Document processing complete: {next_id} document chunks created", end="\n")
+        if self.tokenizer is not None and next_id:
+            print(f"Chunk tokens: mean {token_stats['tokens'] / next_id:.0f}, max {token_stats['max_tokens']}, "
+                  f"{token_stats['truncated_chunks']} chunks truncated at {EMBEDDING_MAX_TOKENS} tokens "
+                  f"({token_stats['truncated_tokens']} of {token_stats['tokens']} tokens not embedded)", end="\n")
+    
+    @staticmethod
+    def _record_tokens(token_stats: Dict[str, int], n_tokens: int):
+        """Accumulate per-chunk token counts and what the embedding model will drop"""
+        token_stats['tokens'] += n_tokens
+        token_stats['max_tokens'] = max(token_stats['max_tokens'], n_tokens)
+        if n_tokens > EMBEDDING_MAX_TOKENS:
+            token_stats['truncated_chunks'] += 1
+            token_stats['truncated_tokens'] += n_tokens - EMBEDDING_MAX_TOKENS
+    
+    def process_document(self, file_path: str) -> List[Dict[str, str]]:
+        """Process document and return chunks with metadata"""
+        documents = list(self.iter_documents(file_path))
+        for document in documents:
+            document['metadata']['total_chunks'] = len(documents)
         return documents
@@ -0,0 +1,136 @@
+import json
+from pathlib import Path
+from typing import Dict, List
+import numpy as np
+from config import (EMBEDDING_MODEL, DEVICE, EMBEDDING_BACKEND, EMBEDDING_MAX_TOKENS,
+                    ONNX_MODEL_DIR, ONNX_QUANTIZED)
+
+ONNX_MODEL_FILE = "model.onnx"
+ONNX_QUANTIZED_MODEL_FILE = "model_int8.onnx"
+PARITY_REPORT_FILE = "parity.json"
+
+
+class TorchEmbeddingBackend:
+    """PyTorch sentence-transformers model"""
+    
+    def __init__(self, model_name: str = EMBEDDING_MODEL, device: str = DEVICE, threads: int = None):
+        import torch
+        from sentence_transformers import SentenceTransformer
+        
+        if threads:
+            torch.set_num_threads(threads)
+        self.model = SentenceTransformer(model_name, device=device)
+        self.name = "torch"
+        self.model_id = model_name
+        self.tokenizer = self.model.tokenizer
+        self.max_seq_length = self.model.max_seq_length
+    
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.model.get_sentence_embedding_dimension()
+    
+    def encode(self, texts: List[str], batch_size: int = 32, show_progress_bar: bool = False,
+               convert_to_numpy: bool = True) -> np.ndarray:
+        return self.model.encode(
+            texts,
+            batch_size=batch_size,
+            show_progress_bar=show_progress_bar,
+            convert_to_numpy=True
+        )
+
+
+class OnnxEmbeddingBackend:
+    """Exported (optionally int8-quantized) model run with ONNX Runtime on CPU.
+    
+    Loads only from files in model_dir, so it works offline once the model
+    has been exported with export_onnx_model.py. Mean pooling and L2
+    normalization reproduce the sentence-transformers pipeline.
+    """
+    
+    def __init__(self, model_dir: Path = ONNX_MODEL_DIR, quantized: bool = ONNX_QUANTIZED, threads: int = None):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+        
+        model_dir = Path(model_dir)
+        model_path = model_dir / (ONNX_QUANTIZED_MODEL_FILE if quantized else ONNX_MODEL_FILE)
+        if not model_path.exists():
+            raise FileNotFoundError(f"{model_path} not found, run: python export_onnx_model.py")
+        
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(str(model_path), options, providers=["CPUExecutionProvider"])
+        self.tokenizer = AutoTokenizer.from_pretrained(str(model_dir))
+        self.max_seq_length = EMBEDDING_MAX_TOKENS
+        self.name = "onnx-int8" if quantized else "onnx"
+        self.model_id = f"{EMBEDDING_MODEL}:{self.name}"
+        self._input_names = {model_input.name for model_input in self.session.get_inputs()}
+        self._dimension = self.session.get_outputs()[0].shape[-1]
+        
+        report = read_parity_report(model_dir).get(self.name)
+        if report and not report['passed']:
+            print(f"Warning: {self.name} embeddings failed the parity check "
+                  f"(min cosine {report['min_cosine']:.4f})", end="\n")
+    
+    def get_sentence_embedding_dimension(self) -> int:
+        return self._dimension
+    
+    def encode(self, texts: List[str], batch_size: int = 32, show_progress_bar: bool = False,
+               convert_to_numpy: bool = True) -> np.ndarray:
+        embeddings = []
+        for start in range(0, len(texts), batch_size):
+            encoded = self.tokenizer(
+                texts[start:start + batch_size],
+                padding=True,
+                truncation=True,
+                max_length=self.max_seq_length,
+                return_tensors="np"
+            )
+            feeds = {name: values.astype(np.int64) for name, values in encoded.items() if name in self._input_names}
+            token_embeddings = self.session.run(None, feeds)[0]
+            
+            mask = encoded['attention_mask'][..., None].astype(np.float32)
+            pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            embeddings.append(pooled.astype(np.float32))
+        
+        if not embeddings:
+            return np.empty((0, self._dimension), dtype=np.float32)
+        return np.concatenate(embeddings)
+
+
+def load_embedding_backend(backend: str = EMBEDDING_BACKEND, threads: int = None):
+    """Embedding backend named in config, falling back to PyTorch if it cannot be loaded"""
+    if backend == "onnx":
+        try:
+            return OnnxEmbeddingBackend(threads=threads)
+        except (ImportError, FileNotFoundError) as e:
+            print(f"ONNX embedding backend unavailable ({str(e)}), using PyTorch", end="\n")
+    return TorchEmbeddingBackend(threads=threads)
+
+
+def check_embedding_parity(reference, candidate, texts: List[str], min_cosine: float) -> Dict:
+    """Compare two backends' embeddings of the same texts row by row"""
+    expected = reference.encode(texts)
+    actual = candidate.encode(texts)
+    expected = expected / np.linalg.norm(expected, axis=1, keepdims=True)
+    actual = actual / np.linalg.norm(actual, axis=1, keepdims=True)
+    cosines = np.sum(expected * actual, axis=1)
+    
+    # Nearest neighbours among the texts themselves should not change either
+    same_neighbours = np.argsort(-(expected @ expected.T), axis=1)[:, 1] == np.argsort(-(actual @ actual.T), axis=1)[:, 1]
+    return {
+        'texts': len(texts),
+        'min_cosine': float(cosines.min()),
+        'mean_cosine': float(cosines.mean()),
+        'neighbour_agreement': float(same_neighbours.mean()),
+        'passed': bool(cosines.min() >= min_cosine)
+    }
+
+
+def read_parity_report(model_dir: Path) -> Dict:
+    path = Path(model_dir) / PARITY_REPORT_FILE
+    if not path.exists():
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
@@ -0,0 +1,135 @@
+import atexit
+import multiprocessing as mp
+import queue
+import threading
+from multiprocessing import shared_memory
+from typing import List
+import numpy as np
+from config import EMBEDDING_BACKEND, available_cpus
+
+
+def _embedding_worker(backend: str, threads: int, tasks, results):
+    """Worker process: load the model once, then encode batches into shared memory"""
+    from embedding_backend import load_embedding_backend
+    
+    model = load_embedding_backend(backend, threads=threads)
+    
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        job, shm_name, shape, indices, texts = task
+        try:
+            shm = shared_memory.SharedMemory(name=shm_name)
+            try:
+                out = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+                out[indices] = model.encode(
+                    texts,
+                    batch_size=len(texts),
+                    show_progress_bar=False,
+                    convert_to_numpy=True
+                )
+                del out
+            finally:
+                shm.close()
+            results.put((job, len(texts), None))
+        except Exception as e:
+            results.put((job, 0, f"{type(e).__name__}: {str(e)}"))
+
+
+class EmbeddingPool:
+    """Pool of worker processes, each holding its own copy of the embedding model.
+    
+    Batches are handed out through a shared task queue so faster workers take
+    more of them, and every worker writes its rows straight into one
+    shared-memory result matrix instead of pickling embeddings back.
+    """
+    
+    def __init__(self, workers: int, dimension: int, backend: str = EMBEDDING_BACKEND):
+        self.workers = workers
+        self.dimension = dimension
+        self.backend = backend
+        self._context = mp.get_context("spawn")
+        self._processes = []
+        self._tasks = None
+        self._results = None
+        self._jobs = 0
+        self._lock = threading.Lock()
+    
+    @property
+    def started(self) -> bool:
+        return bool(self._processes)
+    
+    def start(self):
+        """Spawn the workers (each loads the model in the background)"""
+        if self.started:
+            return
+        threads = max(1, available_cpus() // self.workers)
+        print(f"Starting embedding pool: {self.workers} workers x {threads} threads", end="\n")
+        
+        self._tasks = self._context.Queue()
+        self._results = self._context.Queue()
+        for i in range(self.workers):
+            process = self._context.Process(
+                target=_embedding_worker,
+                args=(self.backend, threads, self._tasks, self._results),
+                name=f"embedding-worker-{i}",
+                daemon=True
+            )
+            process.start()
+            self._processes.append(process)
+        atexit.register(self.close)
+    
+    def encode(self, texts: List[str], batches: List[np.ndarray]) -> np.ndarray:
+        """Encode texts split into the given index batches; rows come back in input order"""
+        with self._lock:
+            self.start()
+            self._jobs += 1
+            job = self._jobs
+            shape = (len(texts), self.dimension)
+            shm = shared_memory.SharedMemory(create=True, size=max(shape[0] * shape[1] * 4, 1))
+            try:
+                for batch in batches:
+                    self._tasks.put((job, shm.name, shape, batch, [texts[i] for i in batch]))
+                
+                pending = len(batches)
+                done = 0
+                while pending:
+                    try:
+                        result_job, count, error = self._results.get(timeout=1.0)
+                    except queue.Empty:
+                        if not all(process.is_alive() for process in self._processes):
+                            self._terminate()
+                            raise RuntimeError("An embedding worker exited unexpectedly")
+                        continue
+                    if result_job != job:
+                        continue  # left over from an earlier failed call
+                    if error:
+                        raise RuntimeError(f"Embedding worker failed: {error}")
+                    pending -= 1
+                    done += count
+                    print(f"Embedded {done}/{len(texts)} texts", end="\n")
+                
+                out = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+                embeddings = out.copy()
+                del out
+                return embeddings
+            finally:
+                shm.close()
+                shm.unlink()
+    
+    def close(self):
+        """Stop the workers"""
+        if not self.started:
+            return
+        for _ in self._processes:
+            self._tasks.put(None)
+        for process in self._processes:
+            process.join(timeout=10)
+        self._terminate()
+    
+    def _terminate(self):
+        for process in self._processes:
+            if process.is_alive():
+                process.terminate()
+        self._processes = []
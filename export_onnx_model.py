@@ -0,0 +1,101 @@
+"""Export the embedding model to ONNX, quantize it to int8 and check parity with PyTorch.
+
+Usage: python export_onnx_model.py [--texts FILE]
+
+The exported files are written to ONNX_MODEL_DIR; set EMBEDDING_BACKEND = "onnx"
+in config.py to use them.
+"""
+import argparse
+import json
+import sys
+from pathlib import Path
+from config import EMBEDDING_MODEL, EMBEDDING_MAX_TOKENS, ONNX_MODEL_DIR, EMBEDDING_PARITY_MIN_COSINE
+from embedding_backend import (TorchEmbeddingBackend, OnnxEmbeddingBackend, check_embedding_parity,
+                               ONNX_MODEL_FILE, ONNX_QUANTIZED_MODEL_FILE, PARITY_REPORT_FILE)
+
+SAMPLE_TEXTS = [
+    "What is photosynthesis?",
+    "Photosynthesis converts light energy into chemical energy stored in glucose.",
+    "Explain the difference between mitosis and meiosis.",
+    "Newton's second law states that force equals mass times acceleration.",
+    "The French Revolution began in 1789 and reshaped European politics.",
+    "How do I solve a quadratic equation using the quadratic formula?",
+    "Chapter 3: Cell Structure and Function",
+    "Enzymes lower the activation energy of chemical reactions, which speeds them up "
+    "without being consumed in the process.",
+    "Compare and contrast renewable and non-renewable energy sources, giving two examples of each.",
+    "The mitochondria is the powerhouse of the cell.",
+]
+
+
+def export_model(output_dir: Path):
+    """Write the transformer as ONNX (float and int8) plus its tokenizer files"""
+    import torch
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from transformers import AutoModel, AutoTokenizer
+    
+    output_dir.mkdir(exist_ok=True, parents=True)
+    print(f"Exporting {EMBEDDING_MODEL} to {output_dir}", end="\n")
+    
+    tokenizer = AutoTokenizer.from_pretrained(EMBEDDING_MODEL)
+    tokenizer.save_pretrained(str(output_dir))
+    model = AutoModel.from_pretrained(EMBEDDING_MODEL)
+    model.eval()
+    
+    sample = tokenizer(SAMPLE_TEXTS[:2], padding=True, truncation=True,
+                       max_length=EMBEDDING_MAX_TOKENS, return_tensors="pt")
+    input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+    
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            tuple(sample[name] for name in input_names),
+            str(output_dir / ONNX_MODEL_FILE),
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes=dynamic_axes,
+            opset_version=14
+        )
+    print(f"Saved {ONNX_MODEL_FILE}", end="\n")
+    
+    quantize_dynamic(
+        str(output_dir / ONNX_MODEL_FILE),
+        str(output_dir / ONNX_QUANTIZED_MODEL_FILE),
+        weight_type=QuantType.QInt8
+    )
+    print(f"Saved {ONNX_QUANTIZED_MODEL_FILE}", end="\n")
+
+
+def run_parity_check(output_dir: Path, texts) -> bool:
+    """Compare both exported models with PyTorch and record the results"""
+    reference = TorchEmbeddingBackend()
+    report = {}
+    for quantized in (False, True):
+        candidate = OnnxEmbeddingBackend(output_dir, quantized=quantized)
+        report[candidate.name] = check_embedding_parity(reference, candidate, texts, EMBEDDING_PARITY_MIN_COSINE)
+        result = report[candidate.name]
+        print(f"{candidate.name}: min cosine {result['min_cosine']:.4f}, mean cosine {result['mean_cosine']:.4f}, "
+              f"neighbour agreement {result['neighbour_agreement']:.2%} -> "
+              f"{'PASSED' if result['passed'] else 'FAILED'}", end="\n")
+    
+    with open(output_dir / PARITY_REPORT_FILE, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    return all(result['passed'] for result in report.values())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--texts", type=Path, help="file with one sample text per line for the parity check")
+    parser.add_argument("--skip-export", action="store_true", help="only re-run the parity check")
+    args = parser.parse_args()
+    
+    texts = SAMPLE_TEXTS
+    if args.texts:
+        with open(args.texts, 'r', encoding='utf-8') as f:
+            texts = [line.strip() for line in f if line.strip()]
+    
+    if not args.skip_export:
+        export_model(ONNX_MODEL_DIR)
+    sys.exit(0 if run_parity_check(ONNX_MODEL_DIR, texts) else 1)
@@ -0,0 +1,409 @@
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional
+import numpy as np
+
+VECTORS_FILE = "vectors.bin"
+RECORDS_FILE = "records.jsonl"
+DELETED_FILE = "deleted.json"
+META_FILE = "meta.json"
+QUERY_BLOCK_ROWS = 65536
+MAX_DELETED_FRACTION = 0.25
+
+
+def matches_where(metadata: Dict, where: Optional[Dict]) -> bool:
+    """Evaluate a Chroma-style metadata filter ($eq, $ne, $gt, $gte, $lt, $lte, $in, $nin, $and, $or)"""
+    if not where:
+        return True
+    for key, condition in where.items():
+        if key == "$and":
+            if not all(matches_where(metadata, clause) for clause in condition):
+                return False
+            continue
+        if key == "$or":
+            if not any(matches_where(metadata, clause) for clause in condition):
+                return False
+            continue
+        
+        value = metadata.get(key)
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        for operator, operand in condition.items():
+            if operator == "$eq":
+                ok = value == operand
+            elif operator == "$ne":
+                ok = value != operand
+            elif operator == "$in":
+                ok = value in operand
+            elif operator == "$nin":
+                ok = value not in operand
+            elif value is None:
+                ok = False
+            elif operator == "$gt":
+                ok = value > operand
+            elif operator == "$gte":
+                ok = value >= operand
+            elif operator == "$lt":
+                ok = value < operand
+            elif operator == "$lte":
+                ok = value <= operand
+            else:
+                raise ValueError(f"Unsupported where operator: {operator}")
+            if not ok:
+                return False
+    return True
+
+
+def source_values(where: Optional[Dict]) -> Optional[List[str]]:
+    """Sources a where clause restricts results to, if it pins 'source' at the top level"""
+    if not where:
+        return None
+    clauses = where.get("$and", [where]) if "$and" in where else [where]
+    for clause in clauses:
+        condition = clause.get("source")
+        if condition is None:
+            continue
+        if not isinstance(condition, dict):
+            return [condition]
+        if "$eq" in condition:
+            return [condition["$eq"]]
+        if "$in" in condition:
+            return list(condition["$in"])
+    return None
+
+
+class FlatCollection:
+    """Exact cosine-similarity index over a memory-mapped embedding matrix.
+    
+    Implements the subset of the Chroma collection API that VectorStore uses
+    (add, get, query, update, delete, count). Embeddings are L2-normalized and stored
+    row by row as float16, or as int8 with a per-row scale, in an append-only file that
+    is mapped read-only, so several processes can share one copy of the pages.
+    Texts and metadata are kept in memory and appended to a JSON-lines file;
+    deleted rows are masked until enough of them accumulate to compact.
+    Rows are also grouped by source, so a query filtered by source only
+    scores the rows of those sources.
+    """
+    
+    def __init__(self, directory: Path, dtype: str = "float16", read_only: bool = False):
+        self.directory = Path(directory)
+        self.read_only = read_only
+        self.dtype = np.dtype(dtype)
+        self.dimension = None
+        self.ids: List[str] = []
+        self.documents: List[str] = []
+        self.metadatas: List[Dict] = []
+        self._rows = {}             # id -> row
+        self._source_rows: Dict[str, List[int]] = {}  # source -> rows (deleted ones included)
+        self._deleted = set()       # rows
+        self._vectors = None
+        self._lock = threading.RLock()
+        
+        if not read_only:
+            self.directory.mkdir(exist_ok=True, parents=True)
+        self._load()
+    
+    def count(self) -> int:
+        return len(self._rows)
+    
+    def add(self, embeddings: List[List[float]], documents: List[str], metadatas: List[Dict], ids: List[str]):
+        """Append rows; ids already present are replaced"""
+        if self.read_only:
+            raise RuntimeError("FlatCollection was opened read-only")
+        if not ids:
+            return
+        vectors = self._normalize(np.asarray(embeddings, dtype=np.float32))
+        with self._lock:
+            if self.dimension is None:
+                self.dimension = vectors.shape[1]
+                self._write_meta()
+            elif vectors.shape[1] != self.dimension:
+                raise ValueError(f"Embedding dimension {vectors.shape[1]} does not match index ({self.dimension})")
+            
+            replaced = [doc_id for doc_id in ids if doc_id in self._rows]
+            if replaced:
+                self.delete(ids=replaced)
+            
+            # Vectors are written before records, so a crash never leaves a record without a vector
+            with open(self.directory / VECTORS_FILE, 'ab') as f:
+                f.write(self._quantize(vectors).tobytes())
+            with open(self.directory / RECORDS_FILE, 'a', encoding='utf-8') as f:
+                for doc_id, document, metadata in zip(ids, documents, metadatas):
+                    f.write(json.dumps({'id': doc_id, 'document': document, 'metadata': metadata}) + "\n")
+            
+            for doc_id, document, metadata in zip(ids, documents, metadatas):
+                self._append(doc_id, document, metadata)
+            self._map_vectors()
+    
+    def update(self, ids: List[str], metadatas: List[Dict]):
+        """Replace the metadata of existing rows, keeping their stored vectors; unknown ids are ignored"""
+        if self.read_only:
+            raise RuntimeError("FlatCollection was opened read-only")
+        with self._lock:
+            changed = False
+            for doc_id, metadata in zip(ids, metadatas):
+                row = self._rows.get(doc_id)
+                if row is None:
+                    continue
+                source = self.metadatas[row].get('source')
+                if metadata.get('source') != source:
+                    self._source_rows[source].remove(row)
+                    self._source_rows.setdefault(metadata.get('source'), []).append(row)
+                    self._source_rows[metadata.get('source')].sort()
+                self.metadatas[row] = metadata
+                changed = True
+            if changed:
+                self._write_records()
+    
+    def _write_records(self):
+        """Rewrite the records file row for row, deleted rows included, so it stays aligned with the vectors"""
+        tmp_path = self.directory / (RECORDS_FILE + ".tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for doc_id, document, metadata in zip(self.ids, self.documents, self.metadatas):
+                f.write(json.dumps({'id': doc_id, 'document': document, 'metadata': metadata}) + "\n")
+        os.replace(tmp_path, self.directory / RECORDS_FILE)
+    
+    def get(self, ids: List[str] = None, where: Dict = None, limit: int = None, offset: int = None,
+            include: List[str] = ("documents", "metadatas")) -> Dict:
+        """Rows by id and/or metadata filter, in insertion order (or the order of ids)"""
+        with self._lock:
+            if ids is not None:
+                rows = [self._rows[doc_id] for doc_id in ids if doc_id in self._rows]
+            else:
+                rows = [row for row in range(len(self.ids)) if row not in self._deleted]
+            if where:
+                rows = [row for row in rows if matches_where(self.metadatas[row], where)]
+            rows = rows[offset or 0:]
+            if limit is not None:
+                rows = rows[:limit]
+            
+            return {
+                'ids': [self.ids[row] for row in rows],
+                'documents': [self.documents[row] for row in rows] if "documents" in include else None,
+                'metadatas': [self.metadatas[row] for row in rows] if "metadatas" in include else None,
+                'embeddings': self._dequantize(self._vectors[rows]).tolist() if "embeddings" in include else None
+            }
+    
+    def query(self, query_embeddings: List[List[float]], n_results: int = 10, where: Dict = None,
+              include: List[str] = ("documents", "metadatas", "distances")) -> Dict:
+        """Exact top-k by cosine similarity; distances are 1 - similarity as in Chroma's cosine space"""
+        queries = self._normalize(np.asarray(query_embeddings, dtype=np.float32))
+        results = {'ids': [], 'documents': [], 'metadatas': [], 'distances': []}
+        # Only the references are taken under the lock. Writers append to these lists and file, or
+        # swap in new ones when compacting, so rows seen here stay valid while scoring without it
+        with self._lock:
+            vectors = self._vectors
+            ids, documents, metadatas = self.ids, self.documents, self.metadatas
+            mask = self._live_mask(where)
+        
+        # A filtered query only reads the rows that can match
+        candidates = np.flatnonzero(mask) if where else None
+        if candidates is not None and vectors is not None:
+            vectors = vectors[candidates]
+        
+        for query in queries:
+            if vectors is None or not mask.any():
+                top, scores = np.empty(0, dtype=np.int64), np.empty(0)
+            else:
+                scores = self._scores(vectors, query)
+                if candidates is None:
+                    scores[~mask] = -np.inf
+                k = min(n_results, int(mask.sum()))
+                top = np.argpartition(-scores, k - 1)[:k]
+                top = top[np.argsort(-scores[top], kind="stable")]
+                scores = scores[top]
+                if candidates is not None:
+                    top = candidates[top]
+            
+            results['ids'].append([ids[row] for row in top])
+            results['documents'].append([documents[row] for row in top])
+            results['metadatas'].append([metadatas[row] for row in top])
+            results['distances'].append((1.0 - scores).tolist())
+        return results
+    
+    def delete(self, ids: List[str] = None, where: Dict = None):
+        """Remove rows by id and/or metadata filter"""
+        if self.read_only:
+            raise RuntimeError("FlatCollection was opened read-only")
+        with self._lock:
+            targets = self.get(ids=ids, where=where, include=[])['ids'] if (ids is not None or where) else []
+            for doc_id in targets:
+                self._deleted.add(self._rows.pop(doc_id))
+            if not targets:
+                return
+            if len(self._deleted) > MAX_DELETED_FRACTION * len(self.ids):
+                self._compact()
+            else:
+                self._write_deleted()
+    
+    def clear(self):
+        if self.read_only:
+            raise RuntimeError("FlatCollection was opened read-only")
+        with self._lock:
+            for name in (VECTORS_FILE, RECORDS_FILE, DELETED_FILE, META_FILE):
+                (self.directory / name).unlink(missing_ok=True)
+            self.dimension = None
+            self.ids, self.documents, self.metadatas = [], [], []
+            self._rows, self._source_rows, self._deleted = {}, {}, set()
+            self._vectors = None
+    
+    def memory_bytes(self) -> int:
+        """Size of the mapped embedding matrix"""
+        return 0 if self._vectors is None else int(self._vectors.nbytes)
+    
+    def _scores(self, vectors: np.ndarray, query: np.ndarray) -> np.ndarray:
+        """Similarity of every row to the query, upcasting the matrix block by block"""
+        scores = np.empty(len(vectors), dtype=np.float32)
+        for start in range(0, len(vectors), QUERY_BLOCK_ROWS):
+            block = vectors[start:start + QUERY_BLOCK_ROWS]
+            if self.dtype == np.int8:
+                scores[start:start + len(block)] = (block['q'].astype(np.float32) @ query) * block['scale']
+            else:
+                scores[start:start + len(block)] = block.astype(np.float32) @ query
+        return scores
+    
+    def _live_mask(self, where: Dict = None) -> np.ndarray:
+        sources = source_values(where)
+        if sources is None:
+            mask = np.ones(len(self.ids), dtype=bool)
+        else:
+            mask = np.zeros(len(self.ids), dtype=bool)
+            for source in sources:
+                mask[self._source_rows.get(source, [])] = True
+        if self._deleted:
+            mask[list(self._deleted)] = False
+        if where:
+            for row in np.flatnonzero(mask):
+                if not matches_where(self.metadatas[row], where):
+                    mask[row] = False
+        return mask
+    
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        if vectors.ndim == 1:
+            vectors = vectors[None, :]
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.clip(norms, 1e-12, None)
+    
+    @property
+    def _row_dtype(self) -> np.dtype:
+        """On-disk row layout; int8 rows carry their own float32 scale"""
+        if self.dtype == np.int8:
+            return np.dtype([('q', np.int8, (self.dimension,)), ('scale', np.float32)])
+        return np.dtype((self.dtype, (self.dimension,)))
+    
+    def _quantize(self, vectors: np.ndarray) -> np.ndarray:
+        if self.dtype == np.int8:
+            rows = np.empty(len(vectors), dtype=self._row_dtype)
+            scale = np.clip(np.abs(vectors).max(axis=1), 1e-12, None) / 127.0
+            rows['q'] = np.rint(vectors / scale[:, None])
+            rows['scale'] = scale
+            return rows
+        return vectors.astype(self.dtype)
+    
+    def _dequantize(self, vectors: np.ndarray) -> np.ndarray:
+        if self.dtype == np.int8:
+            return vectors['q'].astype(np.float32) * vectors['scale'][:, None]
+        return vectors.astype(np.float32)
+    
+    def _map_vectors(self):
+        """(Re)map the vector file read-only at its current length"""
+        if not self.ids or self.dimension is None:
+            self._vectors = None
+            return
+        if self.dtype == np.int8:
+            dtype, shape = self._row_dtype, (len(self.ids),)
+        else:
+            dtype, shape = self.dtype, (len(self.ids), self.dimension)
+        self._vectors = np.memmap(self.directory / VECTORS_FILE, dtype=dtype, mode='r', shape=shape)
+    
+    def _write_meta(self):
+        tmp_path = self.directory / (META_FILE + ".tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'dimension': self.dimension, 'dtype': self.dtype.name}, f)
+        os.replace(tmp_path, self.directory / META_FILE)
+    
+    def _write_deleted(self):
+        tmp_path = self.directory / (DELETED_FILE + ".tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(sorted(self._deleted), f)
+        os.replace(tmp_path, self.directory / DELETED_FILE)
+    
+    def _append(self, doc_id: str, document: str, metadata: Dict):
+        row = len(self.ids)
+        self._rows[doc_id] = row
+        self._source_rows.setdefault(metadata.get('source'), []).append(row)
+        self.ids.append(doc_id)
+        self.documents.append(document)
+        self.metadatas.append(metadata)
+    
+    def _compact(self):
+        """Rewrite the files without deleted rows"""
+        live = [row for row in range(len(self.ids)) if row not in self._deleted]
+        vectors = np.array(self._vectors[live]) if self._vectors is not None else None
+        ids = [self.ids[row] for row in live]
+        documents = [self.documents[row] for row in live]
+        metadatas = [self.metadatas[row] for row in live]
+        self._vectors = None
+        
+        vectors_tmp = self.directory / (VECTORS_FILE + ".tmp")
+        records_tmp = self.directory / (RECORDS_FILE + ".tmp")
+        with open(vectors_tmp, 'wb') as f:
+            if vectors is not None:
+                f.write(vectors.tobytes())
+        with open(records_tmp, 'w', encoding='utf-8') as f:
+            for doc_id, document, metadata in zip(ids, documents, metadatas):
+                f.write(json.dumps({'id': doc_id, 'document': document, 'metadata': metadata}) + "\n")
+        os.replace(vectors_tmp, self.directory / VECTORS_FILE)
+        os.replace(records_tmp, self.directory / RECORDS_FILE)
+        (self.directory / DELETED_FILE).unlink(missing_ok=True)
+        
+        self.ids, self.documents, self.metadatas = [], [], []
+        self._rows, self._source_rows, self._deleted = {}, {}, set()
+        for doc_id, document, metadata in zip(ids, documents, metadatas):
+            self._append(doc_id, document, metadata)
+        self._map_vectors()
+        print(f"Flat index compacted ({len(ids)} rows)", end="\n")
+    
+    def _load(self):
+        meta_path = self.directory / META_FILE
+        if not meta_path.exists():
+            return
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        self.dimension = meta['dimension']
+        self.dtype = np.dtype(meta['dtype'])
+        
+        records_path = self.directory / RECORDS_FILE
+        vectors_path = self.directory / VECTORS_FILE
+        row_bytes = self._row_dtype.itemsize
+        stored_rows = vectors_path.stat().st_size // row_bytes if vectors_path.exists() else 0
+        
+        if records_path.exists():
+            with open(records_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if len(self.ids) == stored_rows:
+                        break
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # torn final line
+                    self._append(record['id'], record['document'], record['metadata'])
+        
+        # Drop vectors written without a matching record
+        if not self.read_only and stored_rows > len(self.ids):
+            os.truncate(vectors_path, len(self.ids) * row_bytes)
+        
+        # Rows, not ids, are recorded since a replaced id appears in the records twice
+        deleted_path = self.directory / DELETED_FILE
+        if deleted_path.exists():
+            with open(deleted_path, 'r', encoding='utf-8') as f:
+                self._deleted = {row for row in json.load(f) if row < len(self.ids)}
+            for row in self._deleted:
+                if self._rows.get(self.ids[row]) == row:
+                    del self._rows[self.ids[row]]
+        
+        self._map_vectors()
+        print(f"Flat index loaded ({self.count()} rows, {self.dtype.name})", end="\n")
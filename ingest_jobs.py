@@ -0,0 +1,207 @@
+import json
+import os
+import queue
+import shutil
+import threading
+import uuid
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, Optional
+from config import INGEST_JOBS_DIR, INGEST_JOB_WORKERS, INGEST_JOB_MAX_ATTEMPTS, UPLOADS_DIR
+
+FINISHED = ("done", "duplicate", "failed")
+KEEP_FINISHED = 100  # Finished jobs nobody collected that are kept before the oldest are dropped
+
+
+class IngestionJobs:
+    """Background queue of document uploads.
+    
+    Submitted files are copied under UPLOADS_DIR and described by a JSON
+    checkpoint in INGEST_JOBS_DIR, then processed by worker threads while the
+    caller polls get() for progress and calls discard() once it has shown
+    the outcome. After every batch written to the
+    vector store the checkpoint records how many chunks are committed, so a
+    job interrupted by a crash or restart is queued again by resume() and
+    continues after those chunks instead of starting over.
+    """
+    
+    def __init__(self, loader, vector_store, workers: int = INGEST_JOB_WORKERS, directory: Path = INGEST_JOBS_DIR):
+        self.loader = loader
+        self.vector_store = vector_store
+        self.workers = workers
+        self.directory = Path(directory)
+        self.directory.mkdir(exist_ok=True, parents=True)
+        self._jobs: Dict[str, Dict] = {}
+        self._queue = queue.Queue()
+        self._changed = threading.Condition()
+        self._threads = []
+    
+    def start(self):
+        """Start the worker threads"""
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"ingest-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+    
+    def submit(self, file_path: str, extra_metadata: Dict = None, replace: bool = False) -> Dict:
+        """Queue an uploaded file for ingestion and return its job.
+        
+        A file named like an indexed document replaces it only when replace
+        is set; otherwise the job fails rather than touch the other document.
+        """
+        job_id = uuid.uuid4().hex[:16]
+        # One directory per job keeps the original filename, which becomes the chunks' source
+        stored_path = UPLOADS_DIR / job_id / Path(file_path).name
+        stored_path.parent.mkdir(parents=True)
+        shutil.copyfile(file_path, stored_path)
+        
+        job = {
+            'id': job_id,
+            'filename': stored_path.name,
+            'path': str(stored_path),
+            'extra_metadata': extra_metadata or {},
+            'status': 'queued',
+            'replace': replace,     # whether an indexed document of the same name may be replaced
+            'mode': None,           # 'add' or 'replace', fixed before anything is written
+            'file_hash': None,
+            'attempts': 0,
+            'total_pages': None,
+            'pages': 0,
+            'chunks': 0,
+            'committed': 0,         # chunks written to the store by this or earlier runs
+            'added': 0,
+            'result': None,
+            'error': None,
+            'revision': 0
+        }
+        with self._changed:
+            self._jobs[job_id] = job
+            self._save(job)
+        self._queue.put(job_id)
+        self.start()
+        print(f"Queued ingestion job {job_id} for {job['filename']}", end="\n")
+        return dict(job)
+    
+    def resume(self) -> int:
+        """Queue again the jobs a previous run left unfinished"""
+        resumed = 0
+        for path in sorted(self.directory.glob("*.json"), key=lambda p: p.stat().st_mtime):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    job = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Skipping unreadable ingestion checkpoint {path.name}: {str(e)}", end="\n")
+                continue
+            if job['status'] in FINISHED or job['id'] in self._jobs:
+                continue
+            
+            job.update(status='queued', revision=0)
+            with self._changed:
+                self._jobs[job['id']] = job
+            if not Path(job['path']).exists():
+                self._finish(job, 'failed', error="the uploaded file is missing")
+                continue
+            if job['attempts'] >= INGEST_JOB_MAX_ATTEMPTS:
+                self._finish(job, 'failed', error=f"gave up after {job['attempts']} interrupted attempts")
+                continue
+            print(f"Resuming ingestion job {job['id']} for {job['filename']} "
+                  f"({job['committed']} chunks already committed)", end="\n")
+            self._queue.put(job['id'])
+            resumed += 1
+        if resumed:
+            self.start()
+        return resumed
+    
+    def get(self, job_id: str) -> Optional[Dict]:
+        """Current state of a job, or None once it has been discarded"""
+        with self._changed:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+    
+    def discard(self, job_id: str):
+        """Forget a finished job whose outcome has been delivered"""
+        with self._changed:
+            job = self._jobs.get(job_id)
+            if job is not None and job['status'] in FINISHED:
+                del self._jobs[job_id]
+    
+    def _work(self):
+        while True:
+            job_id = self._queue.get()
+            with self._changed:
+                job = self._jobs[job_id]
+            try:
+                self._run(job)
+            except Exception as e:
+                print(f"Ingestion job {job_id} failed: {str(e)}", end="\n")
+                self._finish(job, 'failed', error=str(e))
+    
+    def _run(self, job: Dict):
+        """Process one job, checkpointing after every committed batch"""
+        path = job['path']
+        self._update(job, status='running', attempts=job['attempts'] + 1, pages=0, chunks=0,
+                     total_pages=self.loader.count_pages(path), save=True)
+        
+        if job['mode'] is None:
+            file_hash = self.loader.hash_file(path)
+            if self.vector_store.has_file(file_hash):
+                self._finish(job, 'duplicate')
+                return
+            # A new version of an indexed file replaces it in place, but only when asked to:
+            # an unrelated upload may share the filename
+            mode = 'add'
+            if job['filename'] in self.vector_store.list_sources():
+                if not job.get('replace'):
+                    self._finish(job, 'failed', error=f"a document named {job['filename']} is already indexed; "
+                                                      f"choose to replace it or rename the file")
+                    return
+                mode = 'replace'
+            self._update(job, mode=mode, file_hash=file_hash, save=True)
+        
+        documents = self._track(job, self.loader.iter_documents(path, job['file_hash'], job['extra_metadata']))
+        added_before = job['added']
+        
+        def progress(received: int, added: int):
+            self._update(job, committed=received, added=added_before + added, save=True)
+        
+        if job['mode'] == 'replace':
+            result = self.vector_store.replace_source(job['filename'], documents, progress, skip=job['committed'])
+        else:
+            result = self.vector_store.add_documents_stream(documents, progress=progress, skip=job['committed'])
+        
+        if not result['chunks']:
+            self._finish(job, 'failed', error=f"Could not process {job['filename']}")
+            return
+        self._finish(job, 'done', result=dict(result, added=added_before + result['added']))
+    
+    def _track(self, job: Dict, documents: Iterable[Dict]) -> Iterator[Dict]:
+        """Count pages and chunks as the loader produces them"""
+        for chunks, document in enumerate(documents, 1):
+            self._update(job, chunks=chunks, pages=max(job['pages'], document['metadata'].get('page', 0)))
+            yield document
+    
+    def _update(self, job: Dict, save: bool = False, **changes):
+        with self._changed:
+            job.update(changes)
+            job['revision'] += 1
+            if save:
+                self._save(job)
+            self._changed.notify_all()
+    
+    def _finish(self, job: Dict, status: str, result: Dict = None, error: str = None):
+        """Record the outcome and drop the checkpoint and the stored copy of the upload"""
+        self._update(job, status=status, result=result, error=error)
+        with self._changed:
+            finished = [job_id for job_id, other in self._jobs.items() if other['status'] in FINISHED]
+            for job_id in finished[:max(len(finished) - KEEP_FINISHED, 0)]:
+                del self._jobs[job_id]
+        (self.directory / f"{job['id']}.json").unlink(missing_ok=True)
+        shutil.rmtree(Path(job['path']).parent, ignore_errors=True)
+        print(f"Ingestion job {job['id']} for {job['filename']}: {status}", end="\n")
+    
+    def _save(self, job: Dict):
+        tmp_path = self.directory / f"{job['id']}.json.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(job, f)
+        os.replace(tmp_path, self.directory / f"{job['id']}.json")
@@ -1,25 +1,422 @@
 import ollama
+import httpx
+import asyncio
+import queue
+import threading
+import time
 import re
-from typing import Dict, List, Tuple
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Iterator, List, Tuple
 from datetime import datetime
 import json
 from pathlib import Path
-from config import CONVERSATIONS_DIR, MAX_HISTORY_LENGTH
+import numpy as np
+from config import (CONVERSATIONS_DIR, MAX_HISTORY_LENGTH, ANSWER_CACHE_ENABLED,
+                    ANSWER_CACHE_PATH, ANSWER_CACHE_THRESHOLD, ANSWER_CACHE_TTL, ANSWER_CACHE_SIZE,
+                    OLLAMA_HOST, LLM_REQUEST_TIMEOUT, LLM_MAX_CONNECTIONS,
+                    MODEL_CONCURRENCY, DEFAULT_MODEL_CONCURRENCY, MODEL_KEEP_ALIVE, DEFAULT_KEEP_ALIVE,
+                    MODEL_RESIDENCY_POLICY, RESIDENCY_REFRESH_INTERVAL,
+                    LOAD_AWARE_ROUTING, ROUTING_LATENCY_SLO, ROUTING_DEFAULT_LATENCY,
+                    ROUTING_PROMOTE_SIMPLE, ROUTING_ANSWER_TOKENS, ROUTING_SAMPLE_MAX_AGE,
+                    ROUTING_PROBE_INTERVAL)
+from cache import AnswerCache
+
+
+class AsyncOllamaClient:
+    """asyncio Ollama client with a pooled HTTP connection and per-model limits.
+
+    The client runs on its own event loop thread so synchronous callers
+    (Gradio worker threads) can share one connection pool. Each model has a
+    semaphore bounding concurrent requests; requests beyond the limit wait
+    in a queue whose depth is exposed through stats().
+    
+    Besides the raw time of each request, its latency is recorded normalized
+    to an answer of ROUTING_ANSWER_TOKENS tokens (from Ollama's own timings,
+    leaving out model loading) so long and short answers are comparable.
+    Samples older than ROUTING_SAMPLE_MAX_AGE are ignored.
+    """
+
+    def __init__(self, host: str = OLLAMA_HOST, timeout: float = LLM_REQUEST_TIMEOUT,
+                 concurrency: Dict[str, int] = None):
+        self.timeout = timeout
+        self.concurrency = dict(MODEL_CONCURRENCY if concurrency is None else concurrency)
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._metrics: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+        
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="ollama-client", daemon=True)
+        self._thread.start()
+        
+        self.client = ollama.AsyncClient(
+            host=host,
+            timeout=httpx.Timeout(timeout, connect=10.0),
+            limits=httpx.Limits(max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=LLM_MAX_CONNECTIONS)
+        )
+    
+    def _model_metrics(self, model: str) -> Dict:
+        with self._lock:
+            if model not in self._metrics:
+                self._metrics[model] = {
+                    'waiting': 0, 'running': 0, 'completed': 0, 'failed': 0, 'timeouts': 0,
+                    'latencies': deque(maxlen=200), 'last_finished': None
+                }
+            return self._metrics[model]
+    
+    @staticmethod
+    def _normalized_latency(seconds: float, response) -> float:
+        """Seconds the request would have taken for a ROUTING_ANSWER_TOKENS answer on a loaded model"""
+        tokens = response.get('eval_count') if response is not None else None
+        eval_ns = response.get('eval_duration') if response is not None else None
+        if not tokens or not eval_ns:
+            return seconds
+        eval_seconds = eval_ns / 1e9
+        load_seconds = (response.get('load_duration') or 0) / 1e9
+        overhead = max(seconds - eval_seconds - load_seconds, 0.0)
+        return overhead + eval_seconds / tokens * ROUTING_ANSWER_TOKENS
+    
+    @asynccontextmanager
+    async def _slot(self, model: str):
+        """Wait for a free slot of the model, tracking queue depth and latency.
+        
+        Yields a dict in which the request stores Ollama's final response
+        under 'response' so its latency can be normalized.
+        """
+        if model not in self._semaphores:
+            self._semaphores[model] = asyncio.Semaphore(self.concurrency.get(model, DEFAULT_MODEL_CONCURRENCY))
+        metrics = self._model_metrics(model)
+        
+        metrics['waiting'] += 1
+        try:
+            await self._semaphores[model].acquire()
+        finally:
+            metrics['waiting'] -= 1
+        
+        metrics['running'] += 1
+        start = time.perf_counter()
+        request = {'response': None}
+        try:
+            yield request
+            metrics['completed'] += 1
+            seconds = time.perf_counter() - start
+            metrics['latencies'].append(
+                (time.time(), seconds, self._normalized_latency(seconds, request['response']))
+            )
+        except (asyncio.TimeoutError, httpx.TimeoutException):
+            metrics['timeouts'] += 1
+            raise
+        except Exception:
+            metrics['failed'] += 1
+            raise
+        finally:
+            metrics['running'] -= 1
+            metrics['last_finished'] = time.time()
+            self._semaphores[model].release()
+    
+    async def generate(self, model: str, prompt: str, options: Dict = None, **kwargs) -> Dict:
+        """Complete a prompt, bounded by the model's concurrency limit and the request timeout"""
+        async with self._slot(model) as request:
+            request['response'] = await asyncio.wait_for(
+                self.client.generate(model=model, prompt=prompt, options=options, **kwargs),
+                timeout=self.timeout
+            )
+            return request['response']
+    
+    async def generate_stream(self, model: str, prompt: str, options: Dict = None, **kwargs) -> AsyncIterator[Dict]:
+        """Stream a completion; the HTTP read timeout applies between chunks"""
+        async with self._slot(model) as request:
+            stream = await self.client.generate(model=model, prompt=prompt, options=options, stream=True, **kwargs)
+            async for part in stream:
+                if part.get('done'):
+                    request['response'] = part
+                yield part
+    
+    async def load_model(self, model: str, keep_alive: float) -> Dict:
+        """Make Ollama load a model without generating.
+        
+        Runs outside the model's slot so the load time is neither queued
+        behind nor recorded as the latency of a request.
+        """
+        # An empty prompt makes Ollama load the model without generating
+        return await asyncio.wait_for(
+            self.client.generate(model=model, prompt="", keep_alive=keep_alive),
+            timeout=self.timeout
+        )
+    
+    async def list_models(self) -> Dict:
+        return await asyncio.wait_for(self.client.list(), timeout=self.timeout)
+    
+    async def running_models(self) -> List[str]:
+        """Names of the models Ollama currently holds in memory"""
+        # ollama-python has no ps() yet, so call /api/ps on the pooled HTTP client
+        response = await self.client._client.get('/api/ps', timeout=10.0)
+        response.raise_for_status()
+        return [m['name'] for m in response.json().get('models', [])]
+    
+    def run(self, coro):
+        """Run a coroutine on the client loop and wait for its result"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+    
+    def generate_sync(self, model: str, prompt: str, options: Dict = None, **kwargs) -> Dict:
+        return self.run(self.generate(model, prompt, options, **kwargs))
+    
+    def generate_stream_sync(self, model: str, prompt: str, options: Dict = None, **kwargs) -> Iterator[Dict]:
+        """Bridge generate_stream to a blocking iterator"""
+        parts = queue.Queue()
+        finished = object()
+        
+        async def pump():
+            try:
+                async for part in self.generate_stream(model, prompt, options, **kwargs):
+                    parts.put(part)
+            except Exception as e:
+                parts.put(e)
+            finally:
+                parts.put(finished)
+        
+        future = asyncio.run_coroutine_threadsafe(pump(), self.loop)
+        try:
+            while True:
+                part = parts.get()
+                if part is finished:
+                    break
+                if isinstance(part, Exception):
+                    raise part
+                yield part
+        finally:
+            future.cancel()
+    
+    def load_model_sync(self, model: str, keep_alive: float) -> Dict:
+        return self.run(self.load_model(model, keep_alive))
+    
+    def list_models_sync(self) -> Dict:
+        return self.run(self.list_models())
+    
+    def running_models_sync(self) -> List[str]:
+        return self.run(self.running_models())
+    
+    def queue_depth(self, model: str) -> int:
+        """Requests waiting for or holding a slot of the model"""
+        metrics = self._model_metrics(model)
+        return metrics['waiting'] + metrics['running']
+    
+    def stats(self) -> Dict[str, Dict]:
+        """Per-model queue depth, outcome counters and percentiles (seconds) of recent latencies"""
+        result = {}
+        with self._lock:
+            items = list(self._metrics.items())
+        cutoff = time.time() - ROUTING_SAMPLE_MAX_AGE
+        for model, metrics in items:
+            recent = [sample for sample in list(metrics['latencies']) if sample[0] >= cutoff]
+            latencies = np.array([sample[1] for sample in recent]) if recent else None
+            normalized = np.array([sample[2] for sample in recent]) if recent else None
+            result[model] = {
+                'limit': self.concurrency.get(model, DEFAULT_MODEL_CONCURRENCY),
+                'waiting': metrics['waiting'],
+                'running': metrics['running'],
+                'completed': metrics['completed'],
+                'failed': metrics['failed'],
+                'timeouts': metrics['timeouts'],
+                'last_finished': metrics['last_finished'],
+                'p50_latency': float(np.percentile(latencies, 50)) if latencies is not None else None,
+                'p95_latency': float(np.percentile(latencies, 95)) if latencies is not None else None,
+                'p95_normalized_latency': float(np.percentile(normalized, 95)) if normalized is not None else None,
+                'samples': len(recent),
+            }
+        return result
+
+
+class ModelResidencyManager:
+    """Keep Ollama models loaded according to a residency policy.
+
+    Policies:
+    - "all": warm both models at startup and keep each loaded for its MODEL_KEEP_ALIVE
+    - "pin_small": keep the small model loaded forever, load the large one on demand
+    - "lazy": load models on first use only
+    Residency is read from Ollama's /api/ps when available, otherwise it is
+    estimated from the last completed request and the keep-alive.
+    """
+    
+    def __init__(self, client: AsyncOllamaClient, small_model: str, large_model: str,
+                 policy: str = MODEL_RESIDENCY_POLICY):
+        self.client = client
+        self.small_model = small_model
+        self.large_model = large_model
+        self.policy = policy
+        self._loaded_until: Dict[str, float] = {}
+        self._ps_supported = True
+        self._last_refresh = 0.0
+        self._lock = threading.Lock()
+    
+    def keep_alive(self, model: str) -> float:
+        """Seconds Ollama should keep the model after a request (-1 keeps it forever)"""
+        if self.policy == "pin_small" and model == self.small_model:
+            return -1
+        return MODEL_KEEP_ALIVE.get(model, DEFAULT_KEEP_ALIVE)
+    
+    def models_to_warm(self) -> List[str]:
+        if self.policy == "all":
+            return [self.small_model, self.large_model]
+        if self.policy == "pin_small":
+            return [self.small_model]
+        return []
+    
+    def start_warmup(self):
+        """Load the policy's models in the background so startup is not blocked"""
+        models = self.models_to_warm()
+        if models:
+            threading.Thread(target=self.warmup, args=(models,), name="ollama-warmup", daemon=True).start()
+    
+    def warmup(self, models: List[str]):
+        for model in models:
+            print(f"Warming up {model}...", end="\n")
+            try:
+                self.client.load_model_sync(model, self.keep_alive(model))
+                self.mark_loaded(model)
+                print(f"{model} loaded", end="\n")
+            except Exception as e:
+                print(f"Could not warm up {model}: {str(e)}", end="\n")
+    
+    def mark_loaded(self, model: str):
+        """Record that the model just served a request"""
+        keep_alive = self.keep_alive(model)
+        with self._lock:
+            self._loaded_until[model] = float('inf') if keep_alive < 0 else time.time() + keep_alive
+    
+    def refresh(self):
+        """Sync residency with Ollama's list of loaded models"""
+        if not self._ps_supported:
+            return
+        try:
+            running = set(self.client.running_models_sync())
+        except Exception as e:
+            print(f"Model residency unavailable from Ollama, estimating instead: {str(e)}", end="\n")
+            self._ps_supported = False
+            return
+        
+        with self._lock:
+            self._last_refresh = time.time()
+            for model in list(self._loaded_until):
+                if model not in running:
+                    del self._loaded_until[model]
+            for model in running:
+                if model not in self._loaded_until:
+                    keep_alive = self.keep_alive(model)
+                    self._loaded_until[model] = float('inf') if keep_alive < 0 else time.time() + keep_alive
+    
+    def is_loaded(self, model: str) -> bool:
+        if time.time() - self._last_refresh > RESIDENCY_REFRESH_INTERVAL:
+            self.refresh()
+        with self._lock:
+            return self._loaded_until.get(model, 0.0) > time.time()
+    
+    def loaded_models(self) -> List[str]:
+        return [model for model in (self.small_model, self.large_model) if self.is_loaded(model)]
+
+
+class ModelRouter:
+    """Choose a model from the query complexity and the live load of each model.
+
+    The expected latency of a model is the p95 of its recent latencies,
+    normalized to a typical answer length (or a configured prior once those
+    have aged out), scaled by how many requests are ahead in its queue.
+    Complex queries fall back to the small model when the large one would
+    miss the latency SLO; simple queries are promoted to the large model
+    while it is idle and still resident in memory.
+    
+    While complex queries are being degraded, one is still sent to the idle
+    large model every ROUTING_PROBE_INTERVAL seconds so its latency keeps
+    being measured and routing can recover.
+    """
+    
+    def __init__(self, client: AsyncOllamaClient, residency: ModelResidencyManager,
+                 small_model: str, large_model: str):
+        self.client = client
+        self.residency = residency
+        self.small_model = small_model
+        self.large_model = large_model
+        self._last_probe = time.time()
+        self._lock = threading.Lock()
+    
+    def expected_latency(self, model: str, stats: Dict) -> float:
+        """Seconds a new request to the model is expected to take, including queueing"""
+        model_stats = stats.get(model, {})
+        latency = (model_stats.get('p95_normalized_latency')
+                   or ROUTING_DEFAULT_LATENCY.get(model, ROUTING_LATENCY_SLO))
+        queued = model_stats.get('waiting', 0) + model_stats.get('running', 0)
+        limit = model_stats.get('limit') or self.client.concurrency.get(model, DEFAULT_MODEL_CONCURRENCY)
+        return latency * (1 + queued // limit)
+    
+    def _take_probe(self) -> bool:
+        """Whether a degraded complex query should go to the large model to refresh its latency"""
+        with self._lock:
+            if time.time() - self._last_probe < ROUTING_PROBE_INTERVAL:
+                return False
+            self._last_probe = time.time()
+            return True
+    
+    def route(self, complexity: str) -> Dict:
+        """Pick a model and explain why"""
+        preferred = self.large_model if complexity == "complex" else self.small_model
+        if not LOAD_AWARE_ROUTING:
+            return {'model': preferred, 'reason': f"{complexity} query"}
+        
+        stats = self.client.stats()
+        small_latency = self.expected_latency(self.small_model, stats)
+        large_latency = self.expected_latency(self.large_model, stats)
+        large_idle = self.client.queue_depth(self.large_model) == 0
+        
+        if complexity == "complex":
+            if large_latency > ROUTING_LATENCY_SLO and small_latency < large_latency:
+                if large_idle and self._take_probe():
+                    return {'model': self.large_model,
+                            'reason': f"complex query probing {self.large_model} (expected {large_latency:.1f}s)"}
+                return {'model': self.small_model,
+                        'reason': f"complex query degraded: {self.large_model} expected {large_latency:.1f}s "
+                                  f"exceeds {ROUTING_LATENCY_SLO:.0f}s SLO"}
+            return {'model': self.large_model, 'reason': "complex query"}
+        
+        if (ROUTING_PROMOTE_SIMPLE and large_idle and self.residency.is_loaded(self.large_model)
+                and large_latency <= ROUTING_LATENCY_SLO):
+            return {'model': self.large_model,
+                    'reason': f"simple query promoted: {self.large_model} is idle and loaded"}
+        return {'model': self.small_model, 'reason': "simple query"}
+
 
 class LLMManager:
     def __init__(self):
         print("Initializing LLM Manager...", end="\n")
         self.small_model = "phi3:mini"
         self.large_model = "mistral:7b"
+        self.client = AsyncOllamaClient()
+        self.residency = ModelResidencyManager(self.client, self.small_model, self.large_model)
+        self.model_router = ModelRouter(self.client, self.residency, self.small_model, self.large_model)
         
         # Verify models are available
         self._verify_models()
+        self.residency.start_warmup()
         print("LLM Manager initialized successfully", end="\n")
     
+    def _generate(self, model: str, prompt: str, options: Dict) -> Dict:
+        """Complete a prompt with the model's keep-alive and record its residency"""
+        response = self.client.generate_sync(
+            model=model, prompt=prompt, options=options, keep_alive=self.residency.keep_alive(model)
+        )
+        self.residency.mark_loaded(model)
+        return response
+    
+    def _generate_stream(self, model: str, prompt: str, options: Dict) -> Iterator[Dict]:
+        """Streaming counterpart of _generate"""
+        yield from self.client.generate_stream_sync(
+            model=model, prompt=prompt, options=options, keep_alive=self.residency.keep_alive(model)
+        )
+        self.residency.mark_loaded(model)
+    
     def _verify_models(self):
         """Check if models are installed"""
         try:
-            models = ollama.list()
+            models = self.client.list_models_sync()
             available = [m['name'] for m in models['models']]
             
             if self.small_model not in available:
@@ -64,14 +461,21 @@ class LLMManager:
         print(f"Query classified as: {complexity}", end="\n")
         return complexity
     
-    def generate_response(self, query: str, context: str, complexity: str = None) -> str:
+    def route_query(self, complexity: str) -> Dict:
+        """Select the model for a query of the given complexity under current load"""
+        routing = self.model_router.route(complexity)
+        print(f"Routing to {routing['model']}: {routing['reason']}", end="\n")
+        return routing
+    
+    def generate_response(self, query: str, context: str, complexity: str = None, model: str = None) -> str:
         """Generate response using appropriate model"""
         
         if complexity is None:
             complexity = self.classify_query_complexity(query)
         
-        # Select model based on complexity
-        model = self.large_model if complexity == "complex" else self.small_model
+        # Select model based on complexity and load
+        if model is None:
+            model = self.route_query(complexity)['model']
         print(f"Using model: {model}", end="\n")
         
         # Create prompt with context
@@ -80,7 +484,7 @@ class LLMManager:
         try:
             # Generate response
             print("Generating response...", end="\n")
-            response = ollama.generate(
+            response = self._generate(
                 model=model,
                 prompt=prompt,
                 options={
@@ -97,6 +501,37 @@ class LLMManager:
             print(f"Error generating response: {str(e)}", end="\n")
             return f"Error: Could not generate response. {str(e)}"
     
+    def generate_response_stream(self, query: str, context: str, complexity: str = None,
+                                 model: str = None) -> Iterator[str]:
+        """Generate response using appropriate model, yielding text as it arrives"""
+        
+        if complexity is None:
+            complexity = self.classify_query_complexity(query)
+        
+        if model is None:
+            model = self.route_query(complexity)['model']
+        print(f"Using model: {model} (streaming)", end="\n")
+        
+        prompt = self._create_prompt(query, context)
+        
+        try:
+            stream = self._generate_stream(
+                model=model,
+                prompt=prompt,
+                options={
+                    'temperature': 0.7,
+                    'num_predict': 500
+                }
+            )
+            for part in stream:
+                if part['response']:
+                    yield part['response']
+            print("Streaming response complete", end="\n")
+            
+        except Exception as e:
+            print(f"Error generating response: {str(e)}", end="\n")
+            yield f"Error: Could not generate response. {str(e)}"
+    
     def _create_prompt(self, query: str, context: str) -> str:
         """Create prompt with RAG context"""
         prompt = f"""You are an intelligent AI tutor. Use the following context from the student's learning materials to answer their question accurately and clearly.
@@ -240,7 +675,7 @@ Format: Just list the questions numbered 1, 2, 3, etc.
 REVIEW QUESTIONS:"""
 
         try:
-            response = ollama.generate(
+            response = self._generate(
                 model=self.small_model,
                 prompt=prompt,
                 options={'temperature': 0.8, 'num_predict': 300}
@@ -261,7 +696,7 @@ Use the Socratic method - ask guiding questions, point to key concepts, suggest
 HINTS:"""
 
         try:
-            response = ollama.generate(
+            response = self._generate(
                 model=self.small_model,
                 prompt=prompt,
                 options={'temperature': 0.7, 'num_predict': 200}
@@ -295,16 +730,69 @@ class QueryRouter:
     def __init__(self, vector_store, llm_manager):
         self.vector_store = vector_store
         self.llm_manager = llm_manager
+        self.answer_cache = AnswerCache(
+            ANSWER_CACHE_PATH,
+            threshold=ANSWER_CACHE_THRESHOLD,
+            ttl=ANSWER_CACHE_TTL,
+            maxsize=ANSWER_CACHE_SIZE
+        ) if ANSWER_CACHE_ENABLED else None
         print("QueryRouter initialized", end="\n")
     
-    def answer_query(self, query: str, n_results: int = 5) -> Dict:
+    def answer_query(self, query: str, n_results: int = 5, filters: Dict = None) -> Dict:
         """Main pipeline: retrieve context and generate answer"""
+        state = self._prepare_answer(query, n_results, filters)
+        
+        if state['cached'] is not None:
+            answer = state['cached']['answer']
+        else:
+            # Step 3: Generate answer
+            print("\nStep 3: Generating answer...", end="\n")
+            answer = self.llm_manager.generate_response(
+                query, state['context'], state['complexity'], model=state['routing']['model']
+            )
+        
+        return self._finish_answer(state, answer)
+    
+    def answer_query_stream(self, query: str, n_results: int = 5, filters: Dict = None) -> Iterator[Dict]:
+        """Streaming pipeline: yields a 'start' event with the sources, then
+        'token' events as the answer is generated, then a 'done' event with
+        the same result dict answer_query returns"""
+        state = self._prepare_answer(query, n_results, filters)
+        yield {
+            'type': 'start',
+            'complexity': state['complexity'],
+            'model': state['routing']['model'],
+            'routing_reason': state['routing']['reason'],
+            'cached': state['cached'] is not None,
+            'sources': state['sources']
+        }
+        
+        if state['cached'] is not None:
+            answer = state['cached']['answer']
+            yield {'type': 'token', 'text': answer}
+        else:
+            print("\nStep 3: Streaming answer...", end="\n")
+            parts = []
+            stream = self.llm_manager.generate_response_stream(
+                query, state['context'], state['complexity'], model=state['routing']['model']
+            )
+            for text in stream:
+                if text.startswith("Error:"):
+                    state['failed'] = True
+                parts.append(text)
+                yield {'type': 'token', 'text': text}
+            answer = "".join(parts).strip()
+        
+        yield {'type': 'done', 'result': self._finish_answer(state, answer)}
+    
+    def _prepare_answer(self, query: str, n_results: int, filters: Dict = None) -> Dict:
+        """Retrieve context, check the answer cache and classify complexity"""
         print(f"\n=== Processing Query ===", end="\n")
         print(f"Query: {query}", end="\n")
         
         # Step 1: Retrieve relevant context
         print("\nStep 1: Retrieving relevant context...", end="\n")
-        search_results = self.vector_store.query(query, n_results=n_results)
+        search_results = self.vector_store.query(query, n_results=n_results, filters=filters)
         
         # Combine context
         context_chunks = search_results['documents']
@@ -312,23 +800,11 @@ class QueryRouter:
         
         print(f"Retrieved {len(context_chunks)} relevant chunks", end="\n")
         
-        # Step 2: Classify complexity
-        print("\nStep 2: Classifying query complexity...", end="\n")
-        complexity = self.llm_manager.classify_query_complexity(query)
-        
-        # Step 3: Generate answer
-        print("\nStep 3: Generating answer...", end="\n")
-        answer = self.llm_manager.generate_response(query, context, complexity)
-        
-        # Step 4: Add to history
-        sources = [meta['source'] for meta in search_results['metadatas']]
-        if hasattr(self.llm_manager, 'add_to_history'):
-            self.llm_manager.add_to_history(query, answer, sources)
-        
-        return {
+        state = {
             'query': query,
-            'answer': answer,
-            'complexity': complexity,
+            'search_results': search_results,
+            'context': context,
+            'cached': None,
             'sources': [
                 {
                     'text': doc[:200] + "...",
@@ -342,16 +818,62 @@ class QueryRouter:
                 )
             ]
         }
+        
+        # Reuse an answer to a near-identical question over the same context
+        if self.answer_cache is not None:
+            state['level'] = getattr(self.llm_manager, 'student_level', None)
+            state['query_embedding'] = self.vector_store.embed_query(query)
+            state['context_hash'] = AnswerCache.hash_context(context_chunks)
+            state['cached'] = self.answer_cache.lookup(
+                state['query_embedding'], state['level'], state['context_hash']
+            )
+        
+        if state['cached'] is not None:
+            print(f"Answer cache hit (similarity {state['cached']['similarity']:.3f})", end="\n")
+            state['complexity'] = state['cached']['complexity']
+            state['routing'] = {'model': None, 'reason': "answer cache hit"}
+        else:
+            # Step 2: Classify complexity
+            print("\nStep 2: Classifying query complexity...", end="\n")
+            state['complexity'] = self.llm_manager.classify_query_complexity(query)
+            if hasattr(self.llm_manager, 'route_query'):
+                state['routing'] = self.llm_manager.route_query(state['complexity'])
+            else:
+                state['routing'] = {'model': None, 'reason': f"{state['complexity']} query"}
+        
+        return state
+    
+    def _finish_answer(self, state: Dict, answer: str) -> Dict:
+        """Cache the answer, record it in history and build the result"""
+        failed = state.get('failed') or answer.startswith("Error:")
+        if self.answer_cache is not None and state['cached'] is None and not failed:
+            self.answer_cache.put(
+                state['query_embedding'], state['level'], state['context_hash'], answer, state['complexity']
+            )
+        
+        # Step 4: Add to history
+        sources = [meta['source'] for meta in state['search_results']['metadatas']]
+        if hasattr(self.llm_manager, 'add_to_history'):
+            self.llm_manager.add_to_history(state['query'], answer, sources)
+        
+        return {
+            'query': state['query'],
+            'answer': answer,
+            'complexity': state['complexity'],
+            'model': state['routing']['model'],
+            'routing_reason': state['routing']['reason'],
+            'cached': state['cached'] is not None,
+            'sources': state['sources']
+        }
     
-    def generate_quiz(self, topic: str = None, n_questions: int = 3) -> str:
+    def generate_quiz(self, topic: str = None, n_questions: int = 3, filters: Dict = None) -> str:
         """Generate a quiz from uploaded materials"""
         if topic:
-            results = self.vector_store.query(topic, n_results=5)
+            results = self.vector_store.query(topic, n_results=5, filters=filters)
         else:
-            stats = self.vector_store.get_stats()
-            if stats['total_documents'] == 0:
+            if self.vector_store.collection.count() == 0:
                 return "No documents available for quiz generation."
-            results = self.vector_store.query("key concepts main topics", n_results=5)
+            results = self.vector_store.query("key concepts main topics", n_results=5, filters=filters)
         
         context = "\n\n".join(results['documents'])
         
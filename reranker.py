@@ -0,0 +1,97 @@
+import threading
+import time
+from typing import Dict, List, Tuple
+from config import RERANK_MODEL, RERANK_CACHE_SIZE, RERANK_SKIP_MARGIN, RERANK_LATENCY_BUDGET_MS
+from cache import LRUCache, hash_text, normalize_query
+
+try:
+    from flashrank import Ranker, RerankRequest
+    FLASHRANK_AVAILABLE = True
+except ImportError:
+    FLASHRANK_AVAILABLE = False
+    print("FlashRank not available. Install with: pip install flashrank", end="\n")
+
+# Seconds per passage assumed until the cross-encoder has been timed
+DEFAULT_PASSAGE_SECONDS = 0.01
+LATENCY_SMOOTHING = 0.2
+
+
+class Reranker:
+    """Cross-encoder reranking stage in front of the fused hybrid ranking.
+    
+    Scores are cached per (query hash, chunk hash), so a repeated question
+    only sends unseen passages to the model, all of them in one batch. The
+    model is skipped when the fused scores already separate the top results
+    from the rest by RERANK_SKIP_MARGIN, and the number of passages scored is
+    capped so the expected model time fits the latency budget; the per-passage
+    time is measured, so the candidate set shrinks when the host is busy.
+    """
+    
+    def __init__(self, model_name: str = RERANK_MODEL, cache_size: int = RERANK_CACHE_SIZE,
+                 skip_margin: float = RERANK_SKIP_MARGIN, budget_ms: float = RERANK_LATENCY_BUDGET_MS):
+        print(f"Loading reranker: {model_name}", end="\n")
+        self.model = Ranker(model_name=model_name)
+        self.model_name = model_name
+        self.skip_margin = skip_margin
+        self.budget = budget_ms / 1000.0 if budget_ms else None
+        self.score_cache = LRUCache(cache_size)
+        self.passage_seconds = DEFAULT_PASSAGE_SECONDS
+        self.counters = {'calls': 0, 'skipped': 0, 'truncated': 0, 'scored': 0}
+        self._lock = threading.Lock()
+    
+    def rerank(self, query_text: str, candidates: List[Tuple[str, Dict]], n_results: int) -> List[Tuple[str, Dict]]:
+        """Best n_results of the (id, result) candidates, which arrive in fused order"""
+        with self._lock:
+            self.counters['calls'] += 1
+        if len(candidates) <= 1:
+            return candidates[:n_results]
+        
+        # A decisive fused ranking would not change which passages are returned
+        if n_results < len(candidates) and self.skip_margin is not None:
+            margin = candidates[n_results - 1][1]['combined_score'] - candidates[n_results][1]['combined_score']
+            if margin >= self.skip_margin:
+                with self._lock:
+                    self.counters['skipped'] += 1
+                return candidates[:n_results]
+        
+        query_hash = hash_text(normalize_query(query_text))
+        keys = [(query_hash, result['metadata'].get('chunk_hash') or hash_text(result['document']))
+                for _, result in candidates]
+        scores = [self.score_cache.get(key) for key in keys]
+        
+        # Cached scores are free; uncached passages are taken in fused order while they fit the budget
+        uncached = [i for i, score in enumerate(scores) if score is None]
+        limit = len(uncached)
+        if self.budget is not None:
+            limit = max(int(self.budget / self.passage_seconds), n_results - (len(candidates) - len(uncached)), 1)
+        if limit < len(uncached):
+            with self._lock:
+                self.counters['truncated'] += 1
+            uncached = uncached[:limit]
+        
+        if uncached:
+            passages = [{"id": i, "text": candidates[i][1]['document']} for i in uncached]
+            start = time.perf_counter()
+            reranked = self.model.rerank(RerankRequest(query=query_text, passages=passages))
+            elapsed = time.perf_counter() - start
+            for passage in reranked:
+                scores[passage['id']] = float(passage['score'])
+                self.score_cache.put(keys[passage['id']], scores[passage['id']])
+            with self._lock:
+                self.counters['scored'] += len(uncached)
+                self.passage_seconds += LATENCY_SMOOTHING * (elapsed / len(uncached) - self.passage_seconds)
+        
+        # Passages left out by the budget keep their fused order behind the scored ones
+        scored = sorted((i for i, score in enumerate(scores) if score is not None), key=lambda i: -scores[i])
+        rest = [i for i, score in enumerate(scores) if score is None]
+        return [candidates[i] for i in scored + rest][:n_results]
+    
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'model': self.model_name,
+                **self.counters,
+                'passage_ms': round(self.passage_seconds * 1000, 2),
+                'max_passages': int(self.budget / self.passage_seconds) if self.budget is not None else None,
+                'score_cache': self.score_cache.stats()
+            }
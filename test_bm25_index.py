@@ -0,0 +1,82 @@
+from bm25_index import BM25Index, tokenize
+
+
+def _index_with_filler(texts):
+    """Index the given documents plus enough others that one removal does not trigger compaction"""
+    index = BM25Index()
+    index.add(list(texts), list(texts.values()), ["bio.pdf"] * len(texts))
+    filler = [f"filler{i}" for i in range(10)]
+    index.add(filler, [f"unrelated chapter {i}" for i in range(10)], ["other.pdf"] * 10)
+    return index
+
+
+def test_reloaded_index_drops_deleted_copy_of_readded_id(tmp_path):
+    """A chunk deleted in an older segment and re-added in a newer one stays live once"""
+    index = _index_with_filler({"a": "photosynthesis in plants", "b": "cell division"})
+    index.flush(tmp_path)
+
+    index.remove(["a"])
+    index.add(["a"], ["respiration in animals"], ["bio.pdf"])
+    index.flush(tmp_path)
+
+    assert len(index._segments) == 2
+    loaded = BM25Index.load(tmp_path)
+    assert len(loaded) == len(index)
+    assert loaded.avgdl == index.avgdl
+
+    slots, _ = loaded.top_k(tokenize("photosynthesis"), 5)
+    assert len(slots) == 0
+
+    slots, _ = loaded.top_k(tokenize("respiration in"), 5)
+    ids = [loaded.doc_ids[slot] for slot in slots]
+    assert ids == ["a"]
+
+    loaded.remove(["a"])
+    assert "a" not in loaded
+    slots, _ = loaded.top_k(tokenize("respiration"), 5)
+    assert len(slots) == 0
+
+
+def test_compaction_after_reload_keeps_only_live_documents(tmp_path):
+    index = _index_with_filler({"a": "old text"})
+    index.flush(tmp_path)
+    index.remove(["a"])
+    index.add(["a"], ["new text"], ["bio.pdf"])
+    index.flush(tmp_path)
+
+    loaded = BM25Index.load(tmp_path)
+    loaded._compact()
+    assert sorted(doc_id for doc_id in loaded.doc_ids if doc_id is not None).count("a") == 1
+    slots, _ = loaded.top_k(tokenize("old"), 5)
+    assert len(slots) == 0
+    slots, _ = loaded.top_k(tokenize("new"), 5)
+    assert [loaded.doc_ids[slot] for slot in slots] == ["a"]
+
+
+def test_metadata_filters_resolve_to_slots_after_reload(tmp_path):
+    index = BM25Index()
+    index.add(["a", "b", "c"], ["leaf cells", "leaf veins", "leaf fall"], ["bio.pdf"] * 3, [
+        {'subject': "Biology", 'class_name': "9", 'page': 1},
+        {'subject': "Biology", 'class_name': "10", 'page': 4},
+        {'subject': "Geography", 'class_name': "10", 'page': 7},
+    ])
+    index.flush(tmp_path)
+    index.add(["d"], ["leaf litter"], ["bio.pdf"], [{'subject': "Biology", 'class_name': "10"}])
+
+    def ids(slots):
+        return sorted(index.doc_ids[slot] for slot in slots)
+
+    assert ids(index.allowed_slots({'class_name': "10"})) == ["b", "c", "d"]
+    assert ids(index.allowed_slots({'subject': "Biology", 'page_from': 2})) == ["b"]
+    assert ids(index.allowed_slots({'subject': ["Biology", "Geography"], 'page_to': 5})) == ["a", "b"]
+    assert index.allowed_slots({'uploader': "teacher"}) is None
+
+    slots, _ = index.top_k(tokenize("leaf"), 5, allowed=index.allowed_slots({'class_name': "10"}))
+    assert ids(slots) == ["b", "c", "d"]
+
+    index.remove(["b"])
+    index.flush(tmp_path)
+    index = BM25Index.load(tmp_path)
+    assert ids(index.allowed_slots({'class_name': "10"})) == ["c", "d"]
+    index._compact()
+    assert ids(index.allowed_slots({'subject': "Biology"})) == ["a", "d"]
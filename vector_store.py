@@ -6,96 +6,326 @@ try:
 except ImportError:
     pass
 
-import torch
-from sentence_transformers import SentenceTransformer
 import chromadb
-from typing import List, Dict
-from config import (EMBEDDING_MODEL, CHROMA_DB_DIR, DEVICE, 
-                   USE_HYBRID_SEARCH, HYBRID_ALPHA, USE_RERANKING, RERANK_TOP_K)
-from rank_bm25 import BM25Okapi
+import json
+import queue
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple
+from config import (EMBEDDING_MODEL, EMBEDDING_BACKEND, CHROMA_DB_DIR, BM25_INDEX_DIR, DEVICE,
+                   VECTOR_INDEX, FLAT_INDEX_DIR, FLAT_INDEX_DTYPE,
+                   USE_HYBRID_SEARCH, HYBRID_ALPHA, FUSION_METHOD, RRF_K,
+                   USE_RERANKING, RERANK_TOP_K, BM25_REBUILD_BATCH,
+                   QUERY_EMBEDDING_CACHE_SIZE, RETRIEVAL_CACHE_SIZE,
+                   INGEST_BATCH_SIZE, INGEST_QUEUE_BATCHES,
+                   EMBED_TOKEN_BUDGET, EMBED_MAX_BATCH,
+                   USE_EMBEDDING_POOL, EMBEDDING_POOL_WORKERS, EMBEDDING_POOL_MIN_TEXTS,
+                   USE_EMBEDDING_CACHE, EMBEDDING_CACHE_PATH)
+from bm25_index import BM25Index, FILTER_FIELDS, PAGE_FIELD, tokenize
+from embedding_backend import load_embedding_backend
+from embedding_pool import EmbeddingPool
+from flat_index import FlatCollection
+from reranker import Reranker, FLASHRANK_AVAILABLE
+from cache import EmbeddingCache, LRUCache, hash_text, normalize_query
 import numpy as np
 
-try:
-    from flashrank import Ranker, RerankRequest
-    FLASHRANK_AVAILABLE = True
-except ImportError:
-    FLASHRANK_AVAILABLE = False
-    print("FlashRank not available. Install with: pip install flashrank", end="\n")
+
+def build_where(filters: Dict = None) -> Dict:
+    """Translate retrieval filters into a Chroma where clause.
+    
+    'page_from' / 'page_to' bound the page number; any other key (source,
+    subject, class_name, uploader, ...) must equal the value, or be one of
+    the values when a list is given. Empty values are ignored.
+    """
+    clauses = []
+    for key, value in (filters or {}).items():
+        if value is None or value == "" or value == []:
+            continue
+        if key == 'page_from':
+            clauses.append({'page': {'$gte': int(value)}})
+        elif key == 'page_to':
+            clauses.append({'page': {'$lte': int(value)}})
+        elif isinstance(value, (list, tuple, set)):
+            clauses.append({key: {'$in': list(value)}})
+        else:
+            clauses.append({key: value})
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {'$and': clauses}
+
+
+def split_source_filter(filters: Dict = None):
+    """Separate the source filter (a list of sources, or None) from the remaining filters"""
+    remaining = {key: value for key, value in (filters or {}).items()
+                 if value is not None and value != "" and value != []}
+    sources = remaining.pop('source', None)
+    if isinstance(sources, str):
+        sources = [sources]
+    return (list(sources) if sources is not None else None), remaining
+
+
+class IndexSnapshot(NamedTuple):
+    """Keyword index and data version that a query reads together"""
+    bm25: BM25Index
+    version: int
+
 
 class VectorStore:
     def __init__(self):
         print("Initializing Vector Store...", end="\n")
         
         print(f"Loading embedding model: {EMBEDDING_MODEL}", end="\n")
-        self.embedding_model = SentenceTransformer(EMBEDDING_MODEL, device=DEVICE)
-        print(f"Embedding model loaded on {DEVICE}", end="\n")
+        self.embedding_model = load_embedding_backend()
+        print(f"Embedding model loaded on {DEVICE} ({self.embedding_model.name} backend)", end="\n")
         
-        self.client = chromadb.PersistentClient(path=str(CHROMA_DB_DIR))
+        if VECTOR_INDEX == "flat":
+            # Exact search over a memory-mapped matrix, behind the same collection API
+            self.client = None
+            self.collection = FlatCollection(FLAT_INDEX_DIR, dtype=FLAT_INDEX_DTYPE)
+        else:
+            self.client = chromadb.PersistentClient(path=str(CHROMA_DB_DIR))
+            
+            try:
+                self.collection = self.client.get_collection(name="documents")
+                print("Loaded existing collection", end="\n")
+            except:
+                self.collection = self.client.create_collection(
+                    name="documents",
+                    metadata={"hnsw:space": "cosine"}
+                )
+                print("Created new collection", end="\n")
         
-        try:
-            self.collection = self.client.get_collection(name="documents")
-            print("Loaded existing collection", end="\n")
-        except:
-            self.collection = self.client.create_collection(
-                name="documents",
-                metadata={"hnsw:space": "cosine"}
-            )
-            print("Created new collection", end="\n")
+        # Queries read the published snapshot; writers build the next one under the write lock.
+        # The version is bumped on every write so cached retrieval results never outlive the data
+        self._snapshot = IndexSnapshot(BM25Index(), 0)
+        self._write_lock = threading.RLock()
+        self._draft = None
+        self.embedding_cache = LRUCache(QUERY_EMBEDDING_CACHE_SIZE)
+        self.retrieval_cache = LRUCache(RETRIEVAL_CACHE_SIZE)
+        self.embedding_cache_store = EmbeddingCache(EMBEDDING_CACHE_PATH) if USE_EMBEDDING_CACHE else None
         
-        self.bm25 = None
-        self.bm25_corpus = []
-        self.bm25_ids = []
+        # Bulk ingestion fans out to worker processes; queries stay in-process
+        if USE_EMBEDDING_POOL and EMBEDDING_POOL_WORKERS > 1:
+            self.embedding_pool = EmbeddingPool(
+                EMBEDDING_POOL_WORKERS, self.embedding_model.get_sentence_embedding_dimension(),
+                backend=EMBEDDING_BACKEND)
+        else:
+            self.embedding_pool = None
         
         if USE_RERANKING and FLASHRANK_AVAILABLE:
-            print("Loading reranker...", end="\n")
-            self.reranker = Ranker(model_name="ms-marco-MiniLM-L-12-v2")
+            self.reranker = Reranker()
         else:
             self.reranker = None
         
-        self._rebuild_bm25_index()
+        self._load_bm25_index()
         print(f"Vector store initialized. Current documents: {self.collection.count()}", end="\n")
     
+    @property
+    def bm25(self) -> BM25Index:
+        """Keyword index of the published snapshot"""
+        return self._snapshot.bm25
+    
+    @property
+    def version(self) -> int:
+        return self._snapshot.version
+    
+    def _publish(self, bm25: BM25Index):
+        """Switch queries to a new keyword index and data version in one assignment"""
+        self._snapshot = IndexSnapshot(bm25, self._snapshot.version + 1)
+    
+    @contextmanager
+    def _writing(self) -> Iterator[BM25Index]:
+        """Serialize writers and yield the keyword index they should modify.
+        
+        The outermost writer gets a copy of the published index (flushed
+        segments are shared, not copied) and publishes it when done, even on
+        error, so it always matches what reached the collection. Queries keep
+        reading the previous snapshot meanwhile; nested writes reuse the copy.
+        """
+        with self._write_lock:
+            if self._draft is not None:
+                yield self._draft
+                return
+            self._draft = self.bm25.copy() if USE_HYBRID_SEARCH else self.bm25
+            try:
+                yield self._draft
+            finally:
+                self._publish(self._draft)
+                self._draft = None
+    
+    def _load_bm25_index(self):
+        """Map the BM25 snapshot from disk and reconcile it with the collection"""
+        if not USE_HYBRID_SEARCH:
+            return
+        
+        index = BM25Index.load(BM25_INDEX_DIR)
+        if index is None:
+            self._rebuild_bm25_index()
+            return
+        
+        collection_ids = self.collection.get(include=[])['ids']
+        missing = [doc_id for doc_id in collection_ids if doc_id not in index]
+        stale = set(index.live_ids()).difference(collection_ids)
+        
+        if missing or stale:
+            print(f"BM25 snapshot is stale: indexing {len(missing)} and removing {len(stale)} documents", end="\n")
+            index.remove(list(stale))
+            for start in range(0, len(missing), BM25_REBUILD_BATCH):
+                batch = self.collection.get(ids=missing[start:start + BM25_REBUILD_BATCH],
+                                            include=['documents', 'metadatas'])
+                index.add(batch['ids'], batch['documents'], [meta.get('source') for meta in batch['metadatas']],
+                          batch['metadatas'])
+            index.flush(BM25_INDEX_DIR)
+        
+        self._publish(index)
+        print(f"BM25 snapshot loaded ({len(index)} documents)", end="\n")
+    
     def _rebuild_bm25_index(self):
         """Rebuild BM25 index from existing documents"""
         if not USE_HYBRID_SEARCH:
             return
         
+        index = BM25Index()
         count = self.collection.count()
         if count > 0:
             print(f"Rebuilding BM25 index for {count} documents...", end="\n")
-            results = self.collection.get()
-            self.bm25_corpus = [doc.lower().split() for doc in results['documents']]
-            self.bm25_ids = results['ids']
-            self.bm25 = BM25Okapi(self.bm25_corpus)
+            for offset in range(0, count, BM25_REBUILD_BATCH):
+                batch = self.collection.get(limit=BM25_REBUILD_BATCH, offset=offset,
+                                            include=['documents', 'metadatas'])
+                index.add(batch['ids'], batch['documents'], [meta.get('source') for meta in batch['metadatas']],
+                          batch['metadatas'])
             print("BM25 index rebuilt", end="\n")
+        index.flush(BM25_INDEX_DIR)
+        self._publish(index)
     
     def embed_texts(self, texts: List[str]) -> List[List[float]]:
         """Generate embeddings for texts"""
+        if len(texts) <= 1:
+            return self._encode(texts).tolist()
+        
         print(f"Generating embeddings for {len(texts)} texts...", end="\n")
-        embeddings = self.embedding_model.encode(
-            texts,
-            batch_size=32,
-            show_progress_bar=True,
-            convert_to_numpy=True
-        )
+        embeddings = self._encode(texts)
         print("Embeddings generated successfully", end="\n")
         return embeddings.tolist()
     
-    def add_documents(self, documents: List[Dict[str, str]]):
-        """Add documents to vector store"""
+    def _token_lengths(self, texts: List[str]) -> np.ndarray:
+        """Number of tokens each text occupies in the model input, after truncation"""
+        encoded = self.embedding_model.tokenizer(
+            texts,
+            add_special_tokens=True,
+            truncation=True,
+            max_length=self.embedding_model.max_seq_length
+        )
+        return np.fromiter((len(ids) for ids in encoded['input_ids']), dtype=np.int64, count=len(texts))
+    
+    def _length_batches(self, texts: List[str]) -> List[np.ndarray]:
+        """Group text indices by token length into batches bounded by a padded-token budget"""
+        lengths = self._token_lengths(texts)
+        order = np.argsort(-lengths, kind='stable')
+        
+        batches = []
+        start = 0
+        while start < len(order):
+            # Longest first, so the first member sets the padded length of the batch
+            longest = max(int(lengths[order[start]]), 1)
+            size = max(1, min(EMBED_MAX_BATCH, EMBED_TOKEN_BUDGET // longest))
+            batches.append(order[start:start + size])
+            start += size
+        return batches
+    
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        """Encode texts in length-bucketed batches and return embeddings in input order"""
+        if len(texts) <= 1:
+            return self.embedding_model.encode(
+                texts,
+                show_progress_bar=False,
+                convert_to_numpy=True
+            ).reshape(len(texts), -1)
+        
+        batches = self._length_batches(texts)
+        if self.embedding_pool is not None and len(texts) >= EMBEDDING_POOL_MIN_TEXTS:
+            try:
+                return self.embedding_pool.encode(texts, batches)
+            except RuntimeError as e:
+                print(f"Embedding pool failed, encoding in-process: {str(e)}", end="\n")
+        
+        embeddings = None
+        for batch in batches:
+            batch_embeddings = self.embedding_model.encode(
+                [texts[i] for i in batch],
+                batch_size=len(batch),
+                show_progress_bar=False,
+                convert_to_numpy=True
+            )
+            if embeddings is None:
+                embeddings = np.empty((len(texts), batch_embeddings.shape[1]), dtype=batch_embeddings.dtype)
+            embeddings[batch] = batch_embeddings
+        return embeddings
+    
+    def embed_query(self, query_text: str) -> List[float]:
+        """Embed a single query, reusing cached embeddings of identical queries"""
+        return self.embed_queries([query_text])[0]
+    
+    def embed_queries(self, query_texts: List[str]) -> List[List[float]]:
+        """Embed queries, encoding all the uncached ones in a single model call"""
+        keys = [normalize_query(query_text) for query_text in query_texts]
+        embeddings = {key: self.embedding_cache.get(key) for key in dict.fromkeys(keys)}
+        missing = [key for key, embedding in embeddings.items() if embedding is None]
+        if missing:
+            for key, embedding in zip(missing, self._encode(missing).tolist()):
+                self.embedding_cache.put(key, embedding)
+                embeddings[key] = embedding
+        return [embeddings[key] for key in keys]
+    
+    def add_documents(self, documents: List[Dict[str, str]], flush_keyword_index: bool = True) -> int:
+        """Add documents to vector store, skipping chunks that are already indexed"""
         if not documents:
             print("No documents to add", end="\n")
-            return
+            return 0
+        
+        with self._writing() as bm25:
+            return self._add_documents(documents, bm25, flush_keyword_index)
+    
+    def _add_documents(self, documents: List[Dict[str, str]], bm25: BM25Index, flush_keyword_index: bool) -> int:
+        """add_documents body, run while holding the write lock"""
+        # Ids derived from source and content make re-uploads idempotent
+        unique = {}
+        for doc in documents:
+            chunk_hash = hash_text(doc['text'])
+            metadata = dict(doc['metadata'], chunk_hash=chunk_hash)
+            doc_id = self.chunk_id(metadata.get('source', ''), chunk_hash)
+            unique.setdefault(doc_id, (doc['text'], metadata))
+        
+        stored = self.collection.get(ids=list(unique), include=['metadatas'])
+        existing = dict(zip(stored['ids'], stored['metadatas']))
+        ids = [doc_id for doc_id in unique if doc_id not in existing]
+        skipped = len(documents) - len(ids)
+        
+        # Chunks kept from an earlier version take this upload's metadata (file hash, page, subject, ...)
+        changed = sorted(doc_id for doc_id, metadata in existing.items() if metadata != unique[doc_id][1])
+        if changed:
+            self.collection.update(ids=changed, metadatas=[unique[doc_id][1] for doc_id in changed])
+            # The keyword index keeps the filter fields too; chunks whose fields moved are indexed again
+            refiltered = [doc_id for doc_id in changed
+                          if any(existing[doc_id].get(field) != unique[doc_id][1].get(field)
+                                 for field in FILTER_FIELDS + (PAGE_FIELD,))]
+            if USE_HYBRID_SEARCH and refiltered:
+                bm25.add(refiltered, [unique[doc_id][0] for doc_id in refiltered],
+                         [unique[doc_id][1].get('source') for doc_id in refiltered],
+                         [unique[doc_id][1] for doc_id in refiltered])
+                if flush_keyword_index and not ids:
+                    bm25.flush(BM25_INDEX_DIR)
         
-        print(f"Adding {len(documents)} documents to vector store...", end="\n")
+        if not ids:
+            print(f"All {len(documents)} documents are already indexed", end="\n")
+            return 0
         
-        texts = [doc['text'] for doc in documents]
-        metadatas = [doc['metadata'] for doc in documents]
+        print(f"Adding {len(ids)} documents to vector store ({skipped} duplicates skipped)...", end="\n")
         
-        embeddings = self.embed_texts(texts)
+        texts = [unique[doc_id][0] for doc_id in ids]
+        metadatas = [unique[doc_id][1] for doc_id in ids]
         
-        existing_count = self.collection.count()
-        ids = [f"doc_{existing_count + i}" for i in range(len(documents))]
+        embeddings = self._embed_chunks(texts, [metadata['chunk_hash'] for metadata in metadatas])
         
         self.collection.add(
             embeddings=embeddings,  # type: ignore
@@ -105,141 +335,392 @@ class VectorStore:
         )
         
         if USE_HYBRID_SEARCH:
-            for text, doc_id in zip(texts, ids):
-                self.bm25_corpus.append(text.lower().split())
-                self.bm25_ids.append(doc_id)
-            self.bm25 = BM25Okapi(self.bm25_corpus)
+            bm25.add(ids, texts, [metadata.get('source') for metadata in metadatas], metadatas)
+            if flush_keyword_index:
+                bm25.flush(BM25_INDEX_DIR)
         
-        print(f"Successfully added {len(documents)} documents. Total: {self.collection.count()}", end="\n")
+        print(f"Successfully added {len(ids)} documents. Total: {self.collection.count()}", end="\n")
+        return len(ids)
     
-    def query(self, query_text: str, n_results: int = 5) -> Dict:
-        """Search vector store"""
-        if USE_HYBRID_SEARCH and self.bm25:
-            return self._hybrid_query(query_text, n_results)
-        else:
-            return self._semantic_query(query_text, n_results)
+    @staticmethod
+    def chunk_id(source: str, chunk_hash: str) -> str:
+        """Stable id of a chunk within a source document"""
+        return "chunk_" + hash_text(f"{source}\0{chunk_hash}")[:32]
+    
+    def _embed_chunks(self, texts: List[str], chunk_hashes: List[str]) -> List[List[float]]:
+        """Embed chunks, reusing persisted embeddings of identical content"""
+        if self.embedding_cache_store is None:
+            return self.embed_texts(texts)
+        
+        # Keyed by backend too, since exported and quantized models embed slightly differently
+        model_id = self.embedding_model.model_id
+        cached = self.embedding_cache_store.get_many(model_id, chunk_hashes)
+        missing = [i for i, chunk_hash in enumerate(chunk_hashes) if chunk_hash not in cached]
+        print(f"Embedding cache: {len(texts) - len(missing)} hits, {len(missing)} misses", end="\n")
+        
+        if missing:
+            new_embeddings = self.embed_texts([texts[i] for i in missing])
+            new_hashes = [chunk_hashes[i] for i in missing]
+            self.embedding_cache_store.put_many(model_id, new_hashes, new_embeddings)
+            cached.update(zip(new_hashes, new_embeddings))
+        
+        return [cached[chunk_hash] for chunk_hash in chunk_hashes]
+    
+    def has_file(self, file_hash: str) -> bool:
+        """Whether a file with this content hash has already been ingested"""
+        return bool(self.collection.get(where={"file_hash": file_hash}, limit=1, include=[])['ids'])
+    
+    def add_documents_stream(self, documents: Iterable[Dict], batch_size: int = INGEST_BATCH_SIZE,
+                             progress: Callable[[int, int], None] = None, skip: int = 0) -> Dict[str, int]:
+        """Add a stream of documents in bounded batches.
+        
+        Returns how many chunks were received and how many were new.
+        progress(received, added) is called after each batch is written; the
+        first skip documents are counted but not written, for resuming a
+        stream whose earlier batches were already committed.
+        
+        A producer thread pulls documents (and so drives page extraction and
+        chunking) while this thread embeds and writes the previous batch; a
+        bounded queue between them keeps memory flat. The vectors of each
+        batch are searchable as soon as they are written, and the data
+        version is bumped with each batch so cached retrieval results do not
+        hide them; the keyword index switches to include the whole stream
+        when it ends.
+        """
+        with self._writing() as bm25:
+            return self._add_documents_stream(documents, batch_size, bm25, progress, skip)
+    
+    def _add_documents_stream(self, documents: Iterable[Dict], batch_size: int, bm25: BM25Index,
+                              progress: Callable[[int, int], None], skip: int) -> Dict[str, int]:
+        """add_documents_stream body, run while holding the write lock"""
+        batches = queue.Queue(maxsize=INGEST_QUEUE_BATCHES)
+        finished = object()
+        stop = threading.Event()
+        
+        def put(item) -> bool:
+            # Give up if the consumer has stopped so the producer never blocks forever
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.5)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+        
+        def produce():
+            try:
+                batch = []
+                for document in documents:
+                    batch.append(document)
+                    if len(batch) == batch_size:
+                        if not put(batch):
+                            return
+                        batch = []
+                if batch:
+                    put(batch)
+            except Exception as e:
+                put(e)
+            finally:
+                put(finished)
+        
+        producer = threading.Thread(target=produce, name="ingest-producer", daemon=True)
+        producer.start()
+        
+        received = added = 0
+        try:
+            while True:
+                batch = batches.get()
+                if batch is finished:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                if received < skip:
+                    committed = min(skip - received, len(batch))
+                    received += committed
+                    batch = batch[committed:]
+                    if not batch:
+                        continue
+                received += len(batch)
+                batch_added = self.add_documents(batch, flush_keyword_index=False)
+                added += batch_added
+                if batch_added:
+                    # Same keyword index, new version: queries see the new vectors instead of cached results
+                    self._publish(self.bm25)
+                if progress is not None:
+                    progress(received, added)
+        finally:
+            stop.set()
+            # Kept chunks may have been indexed again with new filter fields even if nothing was added
+            if USE_HYBRID_SEARCH and received:
+                bm25.flush(BM25_INDEX_DIR)
+        
+        producer.join()
+        print(f"Streaming ingestion complete: {added} of {received} documents added", end="\n")
+        return {'chunks': received, 'added': added}
+    
+    def query(self, query_text: str, n_results: int = 5, filters: Dict = None) -> Dict:
+        """Search vector store, optionally restricted by metadata filters (see build_where)"""
+        return self.query_batch([query_text], n_results, filters)[0]
+    
+    def query_batch(self, query_texts: List[str], n_results: int = 5, filters: Dict = None) -> List[Dict]:
+        """Search for several queries at once; returns one result per query, shaped like query()'s.
+        
+        Uncached queries are embedded in one model call, sent to the collection
+        in one multi-embedding query and scored against the keyword index in
+        one pass.
+        """
+        where = build_where(filters)
+        where_key = json.dumps(where, sort_keys=True)
+        # One snapshot for the whole call, so a concurrent write cannot mix index versions
+        snapshot = self._snapshot
+        results = {}
+        pending = []
+        for query_text in query_texts:
+            key = normalize_query(query_text)
+            if key in results or key in pending:
+                continue
+            cached = self.retrieval_cache.get((key, n_results, where_key, snapshot.version))
+            if cached is not None:
+                print(f"Retrieval cache hit: '{query_text}'", end="\n")
+                results[key] = cached
+            else:
+                pending.append(key)
+        
+        if pending:
+            if USE_HYBRID_SEARCH and snapshot.bm25:
+                fresh = self._hybrid_query_batch(pending, n_results, filters, where, snapshot.bm25)
+            else:
+                fresh = self._semantic_query_batch(pending, n_results, where)
+            for key, result in zip(pending, fresh):
+                self.retrieval_cache.put((key, n_results, where_key, snapshot.version), result)
+                results[key] = result
+        
+        return [{key: list(value) for key, value in results[normalize_query(query_text)].items()}
+                for query_text in query_texts]
     
-    def _semantic_query(self, query_text: str, n_results: int = 5) -> Dict:
+    def _semantic_query_batch(self, query_texts: List[str], n_results: int = 5, where: Dict = None) -> List[Dict]:
         """Pure semantic search"""
-        print(f"Semantic querying: '{query_text}'", end="\n")
+        print(f"Semantic querying: {len(query_texts)} queries", end="\n")
         
-        query_embedding = self.embed_texts([query_text])[0]
+        query_embeddings = self.embed_queries(query_texts)
         
         results = self.collection.query(
-            query_embeddings=[query_embedding],
-            n_results=n_results
+            query_embeddings=query_embeddings,
+            n_results=n_results,
+            where=where
         )
         
-        print(f"Found {len(results['documents'][0])} results", end="\n")
+        print(f"Found {sum(len(documents) for documents in results['documents'])} results", end="\n")
         
-        return {
-            'documents': results['documents'][0],
-            'metadatas': results['metadatas'][0],
-            'distances': results['distances'][0]
-        }
+        return [{
+            'documents': results['documents'][q],
+            'metadatas': results['metadatas'][q],
+            'distances': results['distances'][q]
+        } for q in range(len(query_texts))]
     
-    def _hybrid_query(self, query_text: str, n_results: int = 5) -> Dict:
+    def _hybrid_query_batch(self, query_texts: List[str], n_results: int = 5, filters: Dict = None,
+                            where: Dict = None, bm25: BM25Index = None) -> List[Dict]:
         """Hybrid semantic + keyword search"""
-        print(f"Hybrid querying: '{query_text}'", end="\n")
+        print(f"Hybrid querying: {len(query_texts)} queries", end="\n")
         
         retrieve_count = RERANK_TOP_K if USE_RERANKING else n_results
+        bm25 = bm25 if bm25 is not None else self.bm25
         
-        query_embedding = self.embed_texts([query_text])[0]
+        query_embeddings = self.embed_queries(query_texts)
         semantic_results = self.collection.query(
-            query_embeddings=[query_embedding],
-            n_results=retrieve_count
+            query_embeddings=query_embeddings,
+            n_results=retrieve_count,
+            where=where
         )
         
-        tokenized_query = query_text.lower().split()
-        bm25_scores = self.bm25.get_scores(tokenized_query)
-        
-        bm25_top_indices = np.argsort(bm25_scores)[::-1][:retrieve_count]
+        # Source filters select BM25 partitions and subject, class and page filters a slot mask
+        # kept in the index; only other fields are resolved through the collection's metadata
+        sources, other_filters = split_source_filter(filters)
+        allowed = None
+        if other_filters:
+            allowed = bm25.allowed_slots(other_filters)
+            if allowed is None:
+                allowed = bm25.slots_for(self.collection.get(where=where, include=[])['ids'])
         
-        combined_results = {}
+        keyword_results = bm25.top_k_batch([tokenize(query_text) for query_text in query_texts],
+                                           retrieve_count, sources, allowed)
+        keyword_ids = [[bm25.doc_ids[slot] for slot in slots] for slots, _ in keyword_results]
         
-        for i, doc_id in enumerate(semantic_results['ids'][0]):
-            semantic_score = 1 - semantic_results['distances'][0][i]
-            combined_results[doc_id] = {
-                'semantic_score': semantic_score,
-                'bm25_score': 0,
-                'document': semantic_results['documents'][0][i],
-                'metadata': semantic_results['metadatas'][0][i]
-            }
+        contents = {}
+        for q in range(len(query_texts)):
+            contents.update(zip(
+                semantic_results['ids'][q],
+                zip(semantic_results['documents'][q], semantic_results['metadatas'][q])
+            ))
+        missing_ids = list(dict.fromkeys(doc_id for ids in keyword_ids for doc_id in ids if doc_id not in contents))
+        if missing_ids:
+            fetched = self.collection.get(ids=missing_ids)
+            contents.update(zip(fetched['ids'], zip(fetched['documents'], fetched['metadatas'])))
         
-        for idx in bm25_top_indices:
-            doc_id = self.bm25_ids[idx]
-            bm25_score = bm25_scores[idx]
+        results = []
+        for q, query_text in enumerate(query_texts):
+            sorted_results = self._fuse_candidates(
+                semantic_results['ids'][q], semantic_results['distances'][q],
+                keyword_ids[q], keyword_results[q][1], contents, retrieve_count
+            )
             
-            if doc_id in combined_results:
-                combined_results[doc_id]['bm25_score'] = bm25_score
+            if USE_RERANKING and self.reranker:
+                print("Reranking results...", end="\n")
+                sorted_results = self.reranker.rerank(query_text, sorted_results, n_results)
             else:
-                doc_data = self.collection.get(ids=[doc_id])
-                if doc_data['documents']:
-                    combined_results[doc_id] = {
-                        'semantic_score': 0,
-                        'bm25_score': bm25_score,
-                        'document': doc_data['documents'][0],
-                        'metadata': doc_data['metadatas'][0]
-                    }
-        
-        for doc_id in combined_results:
-            semantic = combined_results[doc_id]['semantic_score']
-            bm25 = combined_results[doc_id]['bm25_score']
-            max_bm25 = max(bm25_scores) if max(bm25_scores) > 0 else 1
-            bm25_norm = bm25 / max_bm25
+                sorted_results = sorted_results[:n_results]
             
-            combined_results[doc_id]['combined_score'] = (
-                HYBRID_ALPHA * semantic + (1 - HYBRID_ALPHA) * bm25_norm
-            )
+            results.append({
+                'documents': [item[1]['document'] for item in sorted_results],
+                'metadatas': [item[1]['metadata'] for item in sorted_results],
+                'distances': [1 - item[1]['combined_score'] for item in sorted_results]
+            })
         
-        sorted_results = sorted(
-            combined_results.items(),
-            key=lambda x: x[1]['combined_score'],
-            reverse=True
-        )[:retrieve_count]
+        print(f"Found {sum(len(result['documents']) for result in results)} results (hybrid search)", end="\n")
+        return results
+    
+    def _fuse_candidates(self, semantic_ids: List[str], semantic_distances: List[float], keyword_ids: List[str],
+                         keyword_scores: np.ndarray, contents: Dict, retrieve_count: int) -> List:
+        """Best retrieve_count (id, result) pairs of one query's semantic and keyword candidates, by fused score"""
+        candidate_ids = list(dict.fromkeys(semantic_ids + keyword_ids))
+        position = {doc_id: i for i, doc_id in enumerate(candidate_ids)}
+        semantic_idx = np.array([position[doc_id] for doc_id in semantic_ids], dtype=np.int64)
+        keyword_idx = np.array([position[doc_id] for doc_id in keyword_ids], dtype=np.int64)
         
-        if USE_RERANKING and self.reranker:
-            print("Reranking results...", end="\n")
-            passages = [{"text": item[1]['document'], "id": item[0]} for item in sorted_results]
-            
-            rerank_request = RerankRequest(query=query_text, passages=passages)
-            reranked = self.reranker.rerank(rerank_request)
-            
-            sorted_results = [(p['id'], combined_results[p['id']]) for p in reranked[:n_results]]
-        else:
-            sorted_results = sorted_results[:n_results]
+        semantic_scores = np.zeros(len(candidate_ids))
+        semantic_scores[semantic_idx] = 1 - np.asarray(semantic_distances, dtype=np.float64)
+        bm25_scores = np.zeros(len(candidate_ids))
+        bm25_scores[keyword_idx] = keyword_scores
+        combined_scores = self._fuse_scores(semantic_scores, semantic_idx, bm25_scores, keyword_idx)
         
-        documents = [item[1]['document'] for item in sorted_results]
-        metadatas = [item[1]['metadata'] for item in sorted_results]
-        distances = [1 - item[1]['combined_score'] for item in sorted_results]
+        sorted_results = []
+        for i in np.argsort(-combined_scores, kind="stable"):
+            doc_id = candidate_ids[i]
+            if doc_id not in contents:
+                continue
+            document, metadata = contents[doc_id]
+            sorted_results.append((doc_id, {
+                'semantic_score': semantic_scores[i],
+                'bm25_score': bm25_scores[i],
+                'combined_score': float(combined_scores[i]),
+                'document': document,
+                'metadata': metadata
+            }))
+            if len(sorted_results) == retrieve_count:
+                break
+        return sorted_results
+    
+    def _fuse_scores(self, semantic_scores: np.ndarray, semantic_idx: np.ndarray,
+                     bm25_scores: np.ndarray, keyword_idx: np.ndarray) -> np.ndarray:
+        """Fuse semantic and keyword scores of all candidates into one score in [0, 1]"""
+        if FUSION_METHOD == "rrf":
+            # Reciprocal rank fusion, scaled so a first place in both lists scores 1
+            fused = np.zeros(len(semantic_scores))
+            fused[semantic_idx] += 1.0 / (RRF_K + 1 + np.arange(len(semantic_idx)))
+            fused[keyword_idx] += 1.0 / (RRF_K + 1 + np.arange(len(keyword_idx)))
+            return fused * (RRF_K + 1) / 2.0
         
-        print(f"Found {len(documents)} results (hybrid search)", end="\n")
+        max_bm25 = bm25_scores.max() if len(bm25_scores) and bm25_scores.max() > 0 else 1
+        return HYBRID_ALPHA * semantic_scores + (1 - HYBRID_ALPHA) * bm25_scores / max_bm25
+    
+    def source_ids(self, source: str) -> List[str]:
+        """Ids of every chunk of a source document"""
+        return self.collection.get(where={"source": source}, include=[])['ids']
+    
+    def delete_source(self, source: str) -> int:
+        """Remove one document's vectors and keyword postings, leaving the rest of the collection intact"""
+        with self._writing():
+            removed = self._delete_ids(self.source_ids(source))
+        print(f"Deleted {removed} chunks of {source}", end="\n")
+        return removed
+    
+    def replace_source(self, source: str, documents: Iterable[Dict], progress: Callable[[int, int], None] = None,
+                       skip: int = 0) -> Dict[str, int]:
+        """Replace a document with a new version of it.
         
-        return {
-            'documents': documents,
-            'metadatas': metadatas,
-            'distances': distances
-        }
+        Chunk ids depend only on source and content, so unchanged chunks keep
+        their ids and are not re-embedded. New chunks are added first and
+        stale ones removed only afterwards, so queries never see the document
+        missing and a failed ingest leaves the old version in place.
+        progress and skip are passed on to add_documents_stream.
+        """
+        with self._writing():
+            return self._replace_source(source, documents, progress, skip)
+    
+    def _replace_source(self, source: str, documents: Iterable[Dict], progress: Callable[[int, int], None],
+                        skip: int) -> Dict[str, int]:
+        """replace_source body, run while holding the write lock"""
+        old_ids = set(self.source_ids(source))
+        new_ids = set()
+        
+        def tracked():
+            for doc in documents:
+                if doc['metadata'].get('source') != source:
+                    raise ValueError(f"Chunk from {doc['metadata'].get('source')} passed to replace {source}")
+                new_ids.add(self.chunk_id(source, hash_text(doc['text'])))
+                yield doc
+        
+        result = self.add_documents_stream(tracked(), progress=progress, skip=skip)
+        if not result['chunks']:
+            # Nothing could be extracted from the new version; keep the old one
+            result.update(removed=0, kept=len(old_ids))
+            return result
+        result['removed'] = self._delete_ids(sorted(old_ids - new_ids))
+        result['kept'] = len(old_ids & new_ids)
+        print(f"Replaced {source}: {result['added']} chunks added, {result['kept']} kept, "
+              f"{result['removed']} removed", end="\n")
+        return result
+    
+    def _delete_ids(self, ids: List[str]) -> int:
+        """Delete chunks by id from the collection and the keyword index"""
+        if not ids:
+            return 0
+        with self._writing() as bm25:
+            for start in range(0, len(ids), BM25_REBUILD_BATCH):
+                self.collection.delete(ids=ids[start:start + BM25_REBUILD_BATCH])
+            if USE_HYBRID_SEARCH:
+                bm25.remove(ids)
+                bm25.flush(BM25_INDEX_DIR)
+        return len(ids)
     
     def clear_collection(self):
         """Clear all documents from collection"""
-        self.client.delete_collection(name="documents")
-        self.collection = self.client.create_collection(
-            name="documents",
-            metadata={"hnsw:space": "cosine"}
-        )
-        self.bm25 = None
-        self.bm25_corpus = []
-        self.bm25_ids = []
+        with self._writing() as bm25:
+            if self.client is None:
+                self.collection.clear()
+            else:
+                # Emptied in place rather than recreated, so queries holding the collection keep working
+                ids = self.collection.get(include=[])['ids']
+                for start in range(0, len(ids), BM25_REBUILD_BATCH):
+                    self.collection.delete(ids=ids[start:start + BM25_REBUILD_BATCH])
+            bm25.clear()
+            bm25.flush(BM25_INDEX_DIR)
         print("Collection cleared", end="\n")
     
+    def list_sources(self) -> List[str]:
+        """Names of the source documents currently indexed"""
+        if USE_HYBRID_SEARCH:
+            return self.bm25.partition_names()
+        sources = set()
+        for offset in range(0, self.collection.count(), BM25_REBUILD_BATCH):
+            batch = self.collection.get(limit=BM25_REBUILD_BATCH, offset=offset, include=['metadatas'])
+            sources.update(meta.get('source') for meta in batch['metadatas'])
+        return sorted(source for source in sources if source)
+    
     def get_stats(self):
         """Get collection statistics"""
         count = self.collection.count()
         return {
             'total_documents': count,
             'embedding_model': EMBEDDING_MODEL,
+            'embedding_backend': self.embedding_model.name,
+            'vector_index': VECTOR_INDEX,
             'device': DEVICE,
             'hybrid_search': USE_HYBRID_SEARCH,
-            'reranking': USE_RERANKING and self.reranker is not None
+            'reranking': USE_RERANKING and self.reranker is not None,
+            'reranker': self.reranker.stats() if self.reranker else None,
+            'collection_version': self.version,
+            'query_embedding_cache': self.embedding_cache.stats(),
+            'retrieval_cache': self.retrieval_cache.stats(),
+            'embedding_cache': self.embedding_cache_store.stats() if self.embedding_cache_store else None
         }